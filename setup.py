@@ -59,7 +59,8 @@ setup(
         'pyserial',
         'pymodbus',
         'tabulate',
-        'psutil'
+        'psutil',
+        'numpy'
     ],
     extras_require={
         # eg:
@@ -0,0 +1,163 @@
+"""
+Control Things Modbus, aka ctmodbus.py
+
+# Copyright (C) 2019  Justin Searle
+#
+# This program is free software: you can redistribute it and/or modify it under
+# the terms of the GNU General Public License as published by the Free Software
+# Foundation, either version 3 of the License, or any later version.
+#
+# This program is distributed in the hope that it will be useful, but WITHOUT
+# ANY WARRANTY; without even the implied warranty of MERCHANTABILITY or FITNESS
+# FOR A PARTICULAR PURPOSE.  See the GNU General Public License for more
+# details at <http://www.gnu.org/licenses/>.
+"""
+
+import json
+import sys
+import threading
+
+from ctmodbus import jobs
+from ctmodbus.snapshot import TABLES
+
+FORMATS = ["jsonl", "text"]
+EXIT = ["exit", "quit"]  # end the script early
+
+
+class Batch(object):
+    """
+    Run command lines one after another without the terminal UI
+
+    Each command runs like a job, so its dialogs are held back instead of
+    shown, then written out with its output as one record.  Sessions,
+    exports and the historian stay open from one command to the next.
+    Background jobs started with bg are waited for at the end.
+
+    Records are JSON Lines by default.  Each chunk of values is written as
+    it is read, with its table, start, values and output text, so a long
+    poll streams its results instead of holding them.  Each command then
+    ends with a record of its status, remaining output, dialogs and error.
+    """
+
+    def __init__(self, ctui, out=sys.stdout, fmt="jsonl", keep_going=False):
+        assert fmt in FORMATS, f"format must be one of: {', '.join(FORMATS)}"
+        self.ctui = ctui
+        self.out = out
+        self.fmt = fmt
+        self.keep_going = keep_going  # run the rest of the script after a failure
+        self.failed = 0
+        self.interrupted = False
+        self.lock = threading.Lock()  # background jobs write from their threads
+
+    def run(self, lines):
+        """
+        Run every command line, returning an exit status for the shell
+
+        :PARAM: lines: Iterable of command lines, blank and # lines are skipped
+        """
+        self.ctui.jobs.on_chunk = self._write_chunk
+        try:
+            for number, line in enumerate(lines, 1):
+                line = line.strip()
+                if not line or line.startswith("#"):
+                    continue
+                if line in EXIT:
+                    break
+                job = self.execute(number, line)
+                if job.status == "cancelled":  # by Ctrl-C
+                    self.interrupted = True
+                    break
+                if job.status == "failed" and not self.keep_going:
+                    break
+        finally:
+            for job in self.ctui.jobs:
+                if self.interrupted:
+                    job.cancel()
+                self._wait(job)
+                self._write(job, background=True)
+        if self.interrupted:
+            return 130
+        return 1 if self.failed else 0
+
+    def execute(self, number, line):
+        """
+        Run one command line in the foreground and write its record
+
+        :PARAM: number: Line number in the script
+        :PARAM: line: Command line to run
+        """
+        job = jobs.Job(
+            number, line, lambda: self._command(line), on_chunk=self._write_chunk
+        )
+        job.start()
+        self._wait(job)
+        self._write(job)
+        return job
+
+    def _command(self, line):
+        cmd, kwargs = self.ctui.commands.extract(line)
+        assert cmd, f"{line} is not a valid command"
+        # the project, history and help commands need the terminal UI
+        assert (
+            cmd.func.__module__ != "ctui.commands"
+        ), f"{cmd.string} is only available in the terminal UI"
+        return cmd.execute(**kwargs)
+
+    def _wait(self, job):
+        """Wait for job to end, cancelling it on Ctrl-C like jobs cancel"""
+        while job.thread.is_alive():
+            try:
+                job.thread.join(0.1)
+            except KeyboardInterrupt:
+                job.cancel()
+
+    def _write_chunk(self, job, function, start, values, text):
+        """Write one chunk of values as soon as a command reads it"""
+        background = self.ctui.jobs.jobs.get(job.id) is job
+        with self.lock:
+            if self.fmt == "text":
+                self.out.write(text)
+            else:
+                record = {
+                    "line": None if background else job.id,
+                    "job": job.id if background else None,
+                    "table": TABLES[function - 1],
+                    "start": start,
+                    "values": values,
+                    "output": text,
+                }
+                self.out.write(json.dumps(record) + "\n")
+            self.out.flush()
+
+    def _write(self, job, background=False):
+        if job.status == "failed":
+            self.failed += 1
+        with self.lock:
+            if self.fmt == "text":
+                self._write_text(job, background)
+            else:
+                record = {
+                    "line": None if background else job.id,
+                    "job": job.id if background else None,
+                    "command": job.line,
+                    "status": job.status,
+                    "seconds": round(job.elapsed, 6),
+                    "output": job.output_text,
+                    "dialogs": [
+                        {"title": d.get("title", ""), "text": d.get("text", "")}
+                        for d in job.dialogs
+                    ],
+                    "error": job.error,
+                }
+                self.out.write(json.dumps(record) + "\n")
+            self.out.flush()
+
+    def _write_text(self, job, background):
+        if background:
+            self.out.write(f"Job {job.id} {job.status.upper()}: {job.line}\n")
+        self.out.write(job.output_text)
+        for d in job.dialogs:
+            self.out.write("{}\n\n{}\n\n".format(d.get("title", ""), d.get("text", "")))
+        if job.error:
+            where = f"job {job.id}" if background else f"line {job.id}"
+            sys.stderr.write(f"Error on {where} ({job.line}): {job.error}\n")
@@ -0,0 +1,209 @@
+"""
+Control Things Modbus, aka ctmodbus.py
+
+# Copyright (C) 2019  Justin Searle
+#
+# This program is free software: you can redistribute it and/or modify it under
+# the terms of the GNU General Public License as published by the Free Software
+# Foundation, either version 3 of the License, or any later version.
+#
+# This program is distributed in the hope that it will be useful, but WITHOUT
+# ANY WARRANTY; without even the implied warranty of MERCHANTABILITY or FITNESS
+# FOR A PARTICULAR PURPOSE.  See the GNU General Public License for more
+# details at <http://www.gnu.org/licenses/>.
+"""
+
+import hashlib
+import json
+import threading
+from contextlib import contextmanager
+from pathlib import Path
+
+_local = threading.local()
+_active = set()  # checkpoint paths in use by a running command
+_lock = threading.Lock()
+
+
+def current():
+    """The checkpoint of the command running on this thread, or None"""
+    return getattr(_local, "checkpoint", None)
+
+
+class Checkpoint(object):
+    """
+    Progress of one read command, appended to a file chunk by chunk
+
+    The file is JSON Lines: a header naming the command and its arguments,
+    then one line per chunk read.  A read that is cut short leaves the file
+    behind, so resume can re-run the command and send only the chunks that
+    are not in the file yet.  Chunks of a serial scan also name the device
+    and unit they were read from.
+    """
+
+    def __init__(self, path, command, kwargs, chunks=None):
+        self.path = Path(path).expanduser()
+        self.command = command
+        self.kwargs = kwargs
+        self.chunks = chunks or {}  # {(device, unit, function, start): values}
+        self.interrupted = False
+        self.final = False  # nothing left worth resuming, even if the command fails
+        self.file = None
+        self.lock = threading.Lock()  # scan workers put chunks from many threads
+
+    def __repr__(self):
+        args = " ".join(str(value) for value in self.kwargs.values())
+        return "{} {} ({} chunks read)".format(self.command, args, len(self.chunks))
+
+    @classmethod
+    def load(cls, path):
+        """Load the checkpoint left by an interrupted command"""
+        path = Path(path).expanduser()
+        assert path.is_file(), "There is no interrupted read to resume"
+        with open(path) as f:
+            lines = f.read().split("\n")
+        header = json.loads(lines[0])
+        chunks = {}
+        for line in lines[1:]:
+            try:
+                chunk = json.loads(line)
+            except ValueError:
+                continue  # blank, or cut off mid write
+            key = (chunk.get("device"), chunk.get("unit"))
+            chunks[key + (chunk["function"], chunk["start"])] = chunk["values"]
+        return cls(path, header["command"], header["kwargs"], chunks)
+
+    def get(self, function, start, count, device=None, unit=None):
+        """
+        Values of a chunk read before the interruption, or None
+
+        :PARAM: function: Modbus read function code 1-4
+        :PARAM: start: Address of the first value
+        :PARAM: count: Number of values in the chunk
+        :PARAM: device: Serial device the chunk was scanned from, if any
+        :PARAM: unit: Unit id the chunk was scanned from, if any
+        """
+        values = self.chunks.get((device, unit, function, start))
+        return values if values is not None and len(values) == count else None
+
+    def put(self, function, start, values, device=None, unit=None):
+        """
+        Record a chunk as read
+
+        :PARAM: function: Modbus read function code 1-4
+        :PARAM: start: Address of the first value
+        :PARAM: values: List of int values, one per address
+        :PARAM: device: Serial device the chunk was scanned from, if any
+        :PARAM: unit: Unit id the chunk was scanned from, if any
+        """
+        values = [int(value) for value in values]
+        record = {"function": function, "start": start, "values": values}
+        if device is not None:
+            record.update(device=device, unit=unit)
+        with self.lock:
+            self.chunks[(device, unit, function, start)] = values
+            self.file.write(json.dumps(record) + "\n")
+            self.file.flush()
+
+    def open(self):
+        if self.chunks:
+            self.file = open(self.path, "a")
+        else:
+            self.path.parent.mkdir(parents=True, exist_ok=True)
+            self.file = open(self.path, "w")
+            header = {"command": self.command, "kwargs": self.kwargs}
+            self.file.write(json.dumps(header) + "\n")
+            self.file.flush()
+
+    def close(self, complete):
+        """Close the file, removing it once there is nothing left to resume"""
+        self.file.close()
+        if complete:
+            self.path.unlink()
+
+
+def path_for(prefix, command, kwargs):
+    """
+    Checkpoint file of one command and its arguments
+
+    Each command and set of arguments gets its own file, so a quick read
+    after a cut short one does not overwrite what is left to resume.
+
+    :PARAM: prefix: Path and start of the file name, like the project path
+    :PARAM: command: Command string, like read holdingRegisters
+    :PARAM: kwargs: Arguments the command was run with
+    """
+    key = json.dumps([command, kwargs], sort_keys=True)
+    digest = hashlib.sha1(key.encode()).hexdigest()[:12]
+    return Path("{}-{}.checkpoint".format(prefix, digest)).expanduser()
+
+
+def interrupted(prefix):
+    """
+    Checkpoints left by interrupted commands, oldest first
+
+    :PARAM: prefix: Path and start of the file names, as given to track
+    """
+    prefix = Path(prefix).expanduser()
+    paths = prefix.parent.glob(prefix.name + "-*.checkpoint")
+    with _lock:
+        paths = [path for path in paths if path not in _active]
+    paths.sort(key=lambda path: path.stat().st_mtime)
+    return [Checkpoint.load(path) for path in paths]
+
+
+@contextmanager
+def resuming(checkpoint):
+    """
+    Continue checkpoint, instead of starting a new one, while the block runs
+
+    :PARAM: checkpoint: Checkpoint loaded from an interrupted command
+    """
+    _local.resume = checkpoint
+    try:
+        yield
+    finally:
+        _local.resume = None
+
+
+@contextmanager
+def track(prefix, command, **kwargs):
+    """
+    Checkpoint the reads of command to a file of its own while the block runs
+
+    The file is removed when the block finishes unless the reads set
+    interrupted, or the block raised after reading something without the
+    reads setting final.  If the same command is already running, the block
+    runs without a checkpoint.
+
+    :PARAM: prefix: Path and start of the file name, like the project path
+    :PARAM: command: Command string, like read holdingRegisters
+    :PARAM: kwargs: Arguments the command was run with
+    """
+    resume = getattr(_local, "resume", None)
+    if resume and resume.command == command and resume.kwargs == kwargs:
+        checkpoint = resume
+    else:
+        checkpoint = Checkpoint(path_for(prefix, command, kwargs), command, kwargs)
+    with _lock:
+        if checkpoint.path in _active:
+            checkpoint = None
+        else:
+            _active.add(checkpoint.path)
+    if checkpoint is None:
+        yield None
+        return
+    complete = False
+    try:
+        checkpoint.open()
+        _local.checkpoint = checkpoint
+        yield checkpoint
+        complete = not checkpoint.interrupted
+    except BaseException:
+        complete = not checkpoint.chunks  # failed before reading, nothing to resume
+        raise
+    finally:
+        _local.checkpoint = None
+        if checkpoint.file:
+            checkpoint.close(complete or checkpoint.final)
+        with _lock:
+            _active.discard(checkpoint.path)
@@ -13,27 +13,107 @@ Control Things Modbus, aka ctmodbus.py
 # details at <http://www.gnu.org/licenses/>.
 """
 
+import argparse
+import itertools
 import socket
+import sys
+import threading
 from datetime import datetime
 from importlib.metadata import version
+from time import monotonic
 
 from ctui import Ctui
-from ctui.dialogs import message_dialog
 from ctui.types import GreedyBin, GreedyInt
-from pymodbus.client.sync import ModbusSerialClient, ModbusTcpClient, ModbusUdpClient
+from prompt_toolkit.document import Document
+from pymodbus.client.sync import ModbusSerialClient, ModbusTcpClient
 from pymodbus.mei_message import ReadDeviceInformationRequest
+from tabulate import tabulate
 
-from ctmodbus import common
+from ctmodbus import (
+    batch,
+    checkpoint,
+    common,
+    datatypes,
+    export,
+    historian,
+    jobs,
+    loadtest,
+    scan,
+    snapshot,
+    tls,
+    udp,
+)
+from ctmodbus.common import message_dialog
 
-ctmodbus = Ctui()
+# first word of the commands that can run as background jobs
+BACKGROUND = ["read", "poll", "scan", "diff", "resume", "loadtest"]
+RETRIES = 3  # rounds of resending the chunks that got no reply
+BACKOFF = 0.25  # seconds before the first round, doubling for each next one
+MISSES_IN_A_ROW = 5  # chunks without a reply before a device is taken to be gone
+SPLIT_REQUESTS = 24  # most requests spent splitting one refused chunk
+
+
+class Ctmodbus(Ctui):
+    """Ctui whose output_text is kept per thread, so background jobs start empty"""
+
+    _output = threading.local()
+
+    @property
+    def output_text(self):
+        return getattr(self._output, "text", "")
+
+    @output_text.setter
+    def output_text(self, text):
+        self._output.text = text
+
+
+ctmodbus = Ctmodbus()
 ctmodbus.name = "ctmodbus"
 ctmodbus.version = version("ctmodbus")
 ctmodbus.description = "A highly flexible Modbus tool made for penetration testers"
 ctmodbus.prompt = "ctmodbus> "
 
 ctmodbus.session = None
+ctmodbus.export = None
+ctmodbus.historian = None
+ctmodbus.snapshot = snapshot.Snapshot()
+ctmodbus.modbus_ports = common.Loops("502,802", minimum=0, maximum=65535)
 unit_id = 1
-ctmodbus.statusbar = lambda: f"PROJECT: {ctmodbus.project_name} | Connection: {ctmodbus.session}"
+
+
+def _statusbar():
+    """Project and connection, then the progress of each running job"""
+    text = f"PROJECT: {ctmodbus.project_name} | Connection: {ctmodbus.session}"
+    for job in ctmodbus.jobs.running:
+        text += f" | Job {job.id}: {job.progress}"
+    return text
+
+
+def _job_changed(job):
+    """Called from job threads to repaint progress or show a finished job"""
+    app = getattr(ctmodbus, "app", None)
+    if app is None or app.loop is None:
+        return
+    if job.running:
+        app.invalidate()
+    else:
+        app.loop.call_soon_threadsafe(_show_job, job, context=job.context)
+
+
+def _show_job(job):
+    """Append a finished job's output and show the dialogs it held back"""
+    output_field = ctmodbus.layout.output_field
+    text = output_field.text + job.output_text
+    output_field.buffer.document = Document(text=text, cursor_position=len(text))
+    for kwargs in job.dialogs:
+        title = f"{kwargs.get('title', '')} (Job {job.id})"
+        message_dialog(**dict(kwargs, title=title))
+    if job.error:
+        message_dialog(title=f"Error (Job {job.id})", text=job.error)
+
+
+ctmodbus.statusbar = _statusbar
+ctmodbus.jobs = jobs.Jobs(on_change=_job_changed)
 
 
 @ctmodbus.command
@@ -47,17 +127,47 @@ def do_debug(cmd: str):
 
 
 @ctmodbus.command
-def do_connect():
-    """Connect to modbus device/service or list suggestions"""
+def do_connect(ports: str = ""):
+    """
+    Connect to modbus device/service or list suggestions
+
+    :PARAM: ports: Optional ports to also list from now on, like 5020, or all
+    """
+    if ports == "all":
+        listed = None
+    else:
+        if ports:
+            extra = common.Loops(ports, minimum=0, maximum=65535)
+            ctmodbus.modbus_ports = ctmodbus.modbus_ports | extra
+        listed = ctmodbus.modbus_ports
+    listeners = common.listening_ports(listed)
+    probes = scan.probe_all(
+        [(ip, port) for ip, port, _ in listeners if port in ctmodbus.modbus_ports]
+    )
     output_text = "Connected Serial Devices\n"
     output_text += common.list_serial_devices()
     output_text += "\n\n\n"
-    output_text += "Listening Services on Localhost\n"
-    output_text += common.list_listening_ports()
+    output_text += f"Listening Services on Localhost, ports {listed or 'all'}\n"
+    output_text += common.list_listening_ports(listeners, probes)
     output_text += "                                                            \n"
     message_dialog(title="Suggestions", text=output_text)
 
 
+def _snapshot_source(source):
+    """
+    Start a new snapshot if the one so far was read from another device
+
+    :PARAM: source: Device and unit of the new session, like tcp 10.10.10.1:502
+    """
+    source = f"{source} unit {unit_id}"
+    old = ctmodbus.snapshot
+    if len(old) and old.source != source:
+        ctmodbus.snapshot = snapshot.Snapshot(source)
+        return f"Snapshot CLEARED, it held values read from {old.source}\n"
+    old.source = source
+    return ""
+
+
 @ctmodbus.command
 def do_connect_ascii(device: str):
     """
@@ -73,7 +183,11 @@ def do_connect_ascii(device: str):
     assert s.connect(), f"Could not connect to {valid_device}"
     ctmodbus.session = s
     date, time = str(datetime.today()).split()
-    return ctmodbus.output_text + f"ASCII session OPENED with {valid_device}\n"
+    return (
+        ctmodbus.output_text
+        + f"ASCII session OPENED with {valid_device}\n"
+        + _snapshot_source(f"ascii {valid_device}")
+    )
 
 
 @ctmodbus.command
@@ -94,6 +208,7 @@ def do_connect_rtu(device: str):
     return (
         ctmodbus.output_text
         + f"RTU session OPENED with {valid_device}  at {date} {time}\n"
+        + _snapshot_source(f"rtu {valid_device}")
     )
 
 
@@ -115,27 +230,62 @@ def do_connect_tcp(host_port: str):
     return (
         ctmodbus.output_text
         + f"TCP session OPENED with {host}:{port} at {date} {time}\n"
+        + _snapshot_source(f"tcp {host}:{port}")
     )
 
 
 @ctmodbus.command
-def do_connect_udp(host_port: str):
+def do_connect_udp(host_port: str, window: int = 16, retries: int = 3):
     """
     Connect to a Modbus UDP device
 
     :PARAM: host_port: <IP/HOSTNAME>[:<PORT>]
+    :PARAM: window: Optional requests to keep in flight at once (default 16)
+    :PARAM: retries: Optional resends of each unanswered request (default 3)
     """
     assert (
         ctmodbus.session == None
     ), "Session already open.  Close first."  # ToDo assert session type
+    assert window > 0, "window must be at least 1"
     host, port = common.parse_ip_port(host_port)
-    s = ModbusUdpClient(host, port, timeout=3)
+    s = udp.WindowedUdpClient(host, port, window=window, retries=retries, timeout=3)
     assert s.connect(), f"Could not connect to {host}:{port}"
     ctmodbus.session = s
     date, time = str(datetime.today()).split()
     return (
         ctmodbus.output_text
         + f"UDP session OPENED with {host}:{port} at {date} {time}\n"
+        + _snapshot_source(f"udp {host}:{port}")
+    )
+
+
+@ctmodbus.command
+def do_connect_tls(
+    host_port: str, cafile: str = "none", certfile: str = "none", keyfile: str = "none"
+):
+    """
+    Connect to a Modbus/TCP Security device, resuming earlier TLS sessions
+
+    :PARAM: host_port: <IP/HOSTNAME>[:<PORT>], port 802 if not given
+    :PARAM: cafile: Optional CA certificate to verify the device with (default none)
+    :PARAM: certfile: Optional client certificate (default none)
+    :PARAM: keyfile: Optional client private key, if not in certfile (default none)
+    """
+    assert (
+        ctmodbus.session == None
+    ), "Session already open.  Close first."  # ToDo assert session type
+    host, port = common.parse_ip_port(host_port, default_port=802)
+    files = [None if f == "none" else f for f in (cafile, certfile, keyfile)]
+    s = tls.SessionTlsClient(host, port, *files, timeout=3)
+    assert s.connect(), f"Could not connect to {host}:{port}\n\n{s.error}"
+    ctmodbus.session = s
+    date, time = str(datetime.today()).split()
+    return (
+        ctmodbus.output_text
+        + f"TLS session OPENED with {host}:{port} at {date} {time}, {s.version} "
+        + f"{'resumed' if s.resumed else 'full'} handshake in "
+        + f"{s.handshake_time * 1000:.1f} ms\n"
+        + _snapshot_source(f"tls {host}:{port}")
     )
 
 
@@ -147,6 +297,8 @@ def do_close():
     assert (
         ctmodbus.session
     ), "There is not an open session.  Connect to one first."  # ToDo assert session type
+    running = ctmodbus.jobs.running
+    assert not running, f"Job {running[0].id} is still running.  Cancel it first."
     ctmodbus.session.close()
     ctmodbus.session = None
     return ctmodbus.output_text + "Session CLOSED\n"
@@ -184,6 +336,313 @@ def do_read_id():
     return output_text
 
 
+def _read_responses(read, ranges):
+    """
+    Yield the response to a read of each range, pipelined if the session can
+
+    In a background job each response counts toward its progress, and once
+    the job is cancelled no further requests are sent.
+
+    :PARAM: read: Session method that sends the read request
+    :PARAM: ranges: List of (start, stop, count) to read
+    """
+    job = jobs.current()
+    if job:
+        if job.cancelled:
+            return
+        job.expect(len(ranges))
+    session = read.__self__
+    if hasattr(session, "read_many"):
+        reads = [(start, count) for start, stop, count in ranges]
+        responses = session.read_many(read, reads, unit=unit_id)
+    else:
+        responses = (read(start, count, unit=unit_id) for start, stop, count in ranges)
+    for response in responses:
+        if job:
+            job.step()
+        yield response
+        if job and job.cancelled:
+            return
+
+
+def _checkpoint_prefix():
+    return f"{ctmodbus.project_folder}{ctmodbus.project_name}"
+
+
+def _checkpoint(command, **kwargs):
+    """Checkpoint a read or scan command in the project folder, for resume"""
+    return checkpoint.track(_checkpoint_prefix(), command, **kwargs)
+
+
+def _validate_csr(csr, max):
+    """Check csr and max before a checkpoint is started for them"""
+    assert max > 0, "max must be at least 1"
+    common.Loops(csr, minimum=0, maximum=65535)
+
+
+def _read_again(read, start, count):
+    """
+    Send one read request outside the pipelined passes
+
+    :PARAM: read: Session method that sends the read request
+    :PARAM: start: Address of the first value
+    :PARAM: count: Number of values to read
+    """
+    job = jobs.current()
+    if job:
+        job.expect(1)
+    response = read(start, count, unit=unit_id)
+    if job:
+        job.step()
+    return response
+
+
+def _split_chunk(read, start, count):
+    """
+    Read a chunk refused with a Modbus exception as two halves, recursively
+
+    Yields (start, count, response) for each piece read, splitting refused
+    pieces again so the readable addresses next to invalid ones are found.
+    A chunk whose two halves are both refused is taken to be invalid
+    throughout, and no chunk costs more than SPLIT_REQUESTS requests, so a
+    sweep across large invalid areas stays cheap.
+
+    :PARAM: read: Session method that sends the read request
+    :PARAM: start: Address of the first value
+    :PARAM: count: Number of values in the chunk, at least 2
+    """
+    pieces = [(start, count)]
+    requests = 0
+    while pieces and requests + 2 <= SPLIT_REQUESTS:
+        start, count = pieces.pop()
+        half = count // 2
+        halves = [(start, half), (start + half, count - half)]
+        responses = [_read_again(read, *piece) for piece in halves]
+        refused = [hasattr(response, "exception_code") for response in responses]
+        if not requests and all(refused):
+            return
+        requests += 2
+        split = []
+        for (piece_start, piece_count), response, was_refused in zip(
+            halves, responses, refused
+        ):
+            if was_refused and piece_count > 1:
+                split.append((piece_start, piece_count))
+            else:
+                yield piece_start, piece_count, response
+        pieces += reversed(split)  # the lower half first
+
+
+def _store_chunk(desc, function, start, values, results, new=True):
+    """
+    Log one chunk of values and add it to results and the snapshot
+
+    New chunks also go to the open export, historian and checkpoint, while
+    chunks restored from a checkpoint were already sent there.  A job that
+    streams its chunks gets each one with its output text as it arrives.
+
+    :PARAM: desc: Description used when logging responses
+    :PARAM: function: Modbus function code of read
+    :PARAM: start: Address of the first value
+    :PARAM: values: List of values, one per address
+    :PARAM: results: Dict of {address: value} to add the values to
+    :PARAM: new: False for values restored from a checkpoint
+    """
+    values = [int(value) for value in values]
+    stop = start + len(values)
+    results.update(zip(range(start, stop), values))
+    ctmodbus.snapshot.update(function, start, values)
+    if new:
+        if ctmodbus.export:
+            ctmodbus.export.write(function, start, values)
+        if ctmodbus.historian:
+            ctmodbus.historian.write(function, start, values)
+        if checkpoint.current():
+            checkpoint.current().put(function, start, values)
+    if function in (1, 2):
+        text = common.log_and_output_bits(desc, start, stop, results)
+    else:
+        text = common.log_and_output_words(desc, start, stop, results)
+    job = jobs.current()
+    if job and job.on_chunk:
+        job.on_chunk(job, function, start, values, text)
+        return ""  # streamed, so a long poll does not pile it up in memory
+    return text
+
+
+def _read_pass(desc, function, read, ranges, attr, results):
+    """
+    Read each range once, pipelined if the session can
+
+    Returns (output_text, missed, refused), where missed are the ranges that
+    got no reply and refused are (start, count, exception code) of the ones
+    answered with a Modbus exception.  After MISSES_IN_A_ROW replies in a row
+    are missed the device is taken to be gone, and the rest of the ranges
+    count as missed.
+
+    :PARAM: desc: Description used when logging responses
+    :PARAM: function: Modbus function code of read
+    :PARAM: read: Session method that sends the read request
+    :PARAM: ranges: List of (start, stop, count) to read
+    :PARAM: attr: Response attribute holding the values, bits or registers
+    :PARAM: results: Dict of {address: value} to add the values to
+    """
+    output_text = ""
+    missed = []
+    refused = []
+    in_a_row = 0
+    responses = _read_responses(read, ranges)
+    for i, ((start, stop, count), response) in enumerate(zip(ranges, responses)):
+        if hasattr(response, attr):
+            values = getattr(response, attr)[:count]
+            output_text += _store_chunk(desc, function, start, values, results)
+            in_a_row = 0
+        elif hasattr(response, "exception_code"):
+            refused.append((start, count, response.exception_code))
+            in_a_row = 0
+        else:
+            missed.append((start, stop, count))
+            in_a_row += 1
+            if in_a_row >= MISSES_IN_A_ROW:
+                missed += ranges[i + 1 :]
+                break
+    responses.close()
+    return output_text, missed, refused
+
+
+def _read_table(desc, function, read, csr, max, attr):
+    """
+    Read csr in requests of up to max addresses, logging and storing each response
+
+    Chunks already in the running command's checkpoint are not read again.
+    Chunks that got no reply are resent up to RETRIES times, backing off
+    between rounds.  Chunks refused with a Modbus exception are split in
+    halves to find the readable addresses in them.  Whatever is still unread
+    leaves the checkpoint in place for resume.
+
+    :PARAM: desc: Description used when logging responses
+    :PARAM: function: Modbus function code of read
+    :PARAM: read: Session method that sends the read request
+    :PARAM: csr: Comma separated ranges to read
+    :PARAM: max: Max addresses to read per request
+    :PARAM: attr: Response attribute holding the values, bits or registers
+    """
+    job = jobs.current()
+    saved = checkpoint.current()
+    results = {}
+    output_text = ""
+    ranges = list(common.csr_to_ranges(csr, max))
+    todo = []
+    for start, stop, count in ranges:
+        values = saved.get(function, start, count) if saved else None
+        if values is None:
+            todo.append((start, stop, count))
+        else:
+            output_text += _store_chunk(desc, function, start, values, results, False)
+    text, missed, refused = _read_pass(desc, function, read, todo, attr, results)
+    output_text += text
+    for attempt in range(RETRIES):
+        if not missed or jobs.sleep(BACKOFF * 2**attempt):
+            break
+        text, missed, more = _read_pass(desc, function, read, missed, attr, results)
+        output_text += text
+        refused += more
+    unanswered = sum(count for start, stop, count in missed)
+    for start, count, _ in refused:
+        if job and job.cancelled:
+            break
+        if count == 1:
+            continue  # an invalid address
+        for start, count, response in _split_chunk(read, start, count):
+            if hasattr(response, attr):
+                values = getattr(response, attr)[:count]
+                output_text += _store_chunk(desc, function, start, values, results)
+            elif not hasattr(response, "exception_code"):
+                unanswered += count
+    unread = sum(count for start, stop, count in ranges) - len(results)
+    if unread:
+        cancelled = job and job.cancelled
+        if saved and not (unanswered or cancelled):
+            saved.final = True  # retrying refused addresses gets the same answer
+        codes = ", ".join(str(code) for code in sorted({c for *_, c in refused}))
+        assert (
+            results or cancelled or unanswered or not refused
+        ), f"{desc}: {csr} refused (exception {codes})"
+        assert results or cancelled, "No response received"
+        date, time = str(datetime.today()).split()
+        output_text += f"{date} {time} - {desc}: {unread} addresses unread"
+        if saved and (unanswered or cancelled):
+            saved.interrupted = True
+            output_text += ", use resume to retry them"
+        output_text += "\n"
+    return results, output_text
+
+
+def _read_bits(desc, function, read, csr, max):
+    """
+    Read csr in requests of up to max bits, logging and storing each response
+
+    :PARAM: desc: Description used when logging responses
+    :PARAM: function: Modbus function code of read
+    :PARAM: read: Session method that sends the read request
+    :PARAM: csr: Comma separated ranges to read
+    :PARAM: max: Max addresses to read per request
+    """
+    return _read_table(desc, function, read, csr, max, "bits")
+
+
+def _read_words(desc, function, read, csr, max):
+    """
+    Read csr in requests of up to max registers, logging and storing each response
+
+    :PARAM: desc: Description used when logging responses
+    :PARAM: function: Modbus function code of read
+    :PARAM: read: Session method that sends the read request
+    :PARAM: csr: Comma separated ranges to read
+    :PARAM: max: Max addresses to read per request
+    """
+    return _read_table(desc, function, read, csr, max, "registers")
+
+
+def _poll(read_csr, interval, count):
+    """
+    Repeat read_csr count times, starting a new read every interval seconds
+
+    A read that fails, like one during a network outage, is noted as a
+    missed poll and polling goes on, so one outage does not end a long
+    capture.  The poll only fails if every read failed.
+
+    :PARAM: read_csr: Zero argument function returning (results, output_text)
+    :PARAM: interval: Seconds between the start of each read
+    :PARAM: count: Number of times to read
+    """
+    assert count > 0, "count must be at least 1"
+    job = jobs.current()
+    output_text = ctmodbus.output_text
+    next_read = monotonic()
+    polls, missed, error = 0, 0, None
+    for i in range(count):
+        if jobs.sleep(max(0, next_read - monotonic())):
+            break
+        next_read += interval
+        polls += 1
+        try:
+            _, text = read_csr()
+        except AssertionError as e:
+            missed, error = missed + 1, str(e)
+            date, time = str(datetime.today()).split()
+            text = f"{date} {time} - Poll {i + 1} of {count} missed: {error}\n"
+        output_text += text
+        if job:
+            if i == 0:
+                # every read sends the same requests as the first
+                job.fix_total(job.total * count)
+            if job.cancelled:
+                break
+    assert not polls or missed < polls, f"Every poll missed: {error}"
+    return output_text
+
+
 @ctmodbus.command
 def do_read_discreteInputs(csr: str, max: int = 2000):
     """
@@ -194,18 +653,14 @@ def do_read_discreteInputs(csr: str, max: int = 2000):
     """
     assert ctmodbus.session, "There is not an open session.  Connect to one first."
     desc = "(2) Read DisIn"
-    results = {}
-    output_text = ctmodbus.output_text
-    for start, stop, count in common.csr_to_ranges(csr, max):
-        response = ctmodbus.session.read_discrete_inputs(start, count, unit=unit_id)
-        assert hasattr(response, "bits"), "No response received"
-        for address, result in zip(range(start, stop), response.bits):
-            results[address] = int(result)
-        output_text += common.log_and_output_bits(desc, start, stop, results)
+    read = ctmodbus.session.read_discrete_inputs
+    _validate_csr(csr, max)
+    with _checkpoint("read discreteInputs", csr=csr, max=max):
+        results, output_text = _read_bits(desc, 2, read, csr, max)
     ranges = csr.split()[0]
     message = f"{desc}: {ranges}\n\n"
     common.summarize_bit_responses(message, results)
-    return output_text
+    return ctmodbus.output_text + output_text
 
 
 @ctmodbus.command
@@ -218,68 +673,559 @@ def do_read_coils(csr: str, max: int = 2000):
     """
     assert ctmodbus.session, "There is not an open session.  Connect to one first."
     desc = "(1) Read Coils"
-    results = {}
-    output_text = ctmodbus.output_text
-    for start, stop, count in common.csr_to_ranges(csr, max):
-        response = ctmodbus.session.read_coils(start, count, unit=unit_id)
-        assert hasattr(response, "bits"), "No response received"
-        for address, result in zip(range(start, stop), response.bits):
-            results[address] = int(result)
-        output_text += common.log_and_output_bits(desc, start, stop, results)
+    read = ctmodbus.session.read_coils
+    _validate_csr(csr, max)
+    with _checkpoint("read coils", csr=csr, max=max):
+        results, output_text = _read_bits(desc, 1, read, csr, max)
     ranges = csr.split()[0]
     message = f"{desc}: {ranges}\n\n"
     common.summarize_bit_responses(message, results)
-    return output_text
+    return ctmodbus.output_text + output_text
 
 
 @ctmodbus.command
-def do_read_inputRegisters(csr: str, max: int = 125):
+def do_read_inputRegisters(
+    csr: str, max: int = 125, datatype: str = "uint16", order: str = "abcd"
+):
     """
     Read input registers (analog inputs) in format: 30,50,70-99,105
 
     :PARAM: csr: Comma separated ranges to read
     :PARAM: max: Optional max addresses to read per request (default 125)
+    :PARAM: datatype: Optional type to decode registers as (default uint16)
+    :PARAM: order: Optional byte order abcd, badc, cdab or dcba (default abcd)
     """
     assert ctmodbus.session, "There is not an open session.  Connect to one first."
+    datatype, order = datatypes.validate_datatype(datatype, order)
     desc = "(4) Read InReg"
-    results = {}
-    output_text = ctmodbus.output_text
-    for start, stop, count in common.csr_to_ranges(csr, max):
-        response = ctmodbus.session.read_input_registers(start, count, unit=unit_id)
-        assert hasattr(response, "registers"), "No response received"
-        for address, result in zip(range(start, stop), response.registers):
-            results[address] = result
-        output_text += common.log_and_output_words(desc, start, stop, results)
+    read = ctmodbus.session.read_input_registers
+    _validate_csr(csr, max)
+    kwargs = dict(csr=csr, max=max, datatype=datatype, order=order)
+    with _checkpoint("read inputRegisters", **kwargs):
+        results, output_text = _read_words(desc, 4, read, csr, max)
     ranges = csr.split()[0]
     message = f"{desc}: {ranges}\n\n"
-    common.summarize_word_responses(message, results)
-    return output_text
+    if datatype == "uint16" and order == "abcd":
+        common.summarize_word_responses(message, results)
+    else:
+        common.summarize_decoded_responses(message, results, datatype, order)
+    return ctmodbus.output_text + output_text
 
 
 @ctmodbus.command
-def do_read_holdingRegisters(csr: str, max: int = 125):
+def do_read_holdingRegisters(
+    csr: str, max: int = 125, datatype: str = "uint16", order: str = "abcd"
+):
     """
     Read holding registers (analog outputs and internal tags) in format: 30,50,70-99,105
 
     :PARAM: csr: Comma separated ranges to read
     :PARAM: max: Optional max addresses to read per request (default 125)
+    :PARAM: datatype: Optional type to decode registers as (default uint16)
+    :PARAM: order: Optional byte order abcd, badc, cdab or dcba (default abcd)
     """
     assert ctmodbus.session, "There is not an open session.  Connect to one first."
+    datatype, order = datatypes.validate_datatype(datatype, order)
     desc = "(3) Read HoReg"
-    results = {}
-    output_text = ctmodbus.output_text
-    for start, stop, count in common.csr_to_ranges(csr, max):
-        response = ctmodbus.session.read_holding_registers(start, count, unit=unit_id)
-        assert hasattr(response, "registers"), "No response received"
-        for address, result in zip(range(start, stop), response.registers):
-            results[address] = result
-        output_text += common.log_and_output_words(desc, start, stop, results)
+    read = ctmodbus.session.read_holding_registers
+    _validate_csr(csr, max)
+    kwargs = dict(csr=csr, max=max, datatype=datatype, order=order)
+    with _checkpoint("read holdingRegisters", **kwargs):
+        results, output_text = _read_words(desc, 3, read, csr, max)
     ranges = csr.split()[0]
     message = f"{desc}: {ranges}\n\n"
-    common.summarize_word_responses(message, results)
+    if datatype == "uint16" and order == "abcd":
+        common.summarize_word_responses(message, results)
+    else:
+        common.summarize_decoded_responses(message, results, datatype, order)
+    return ctmodbus.output_text + output_text
+
+
+@ctmodbus.command
+def do_resume(number: int = 0):
+    """
+    Continue an interrupted read or scan, sending only the chunks it never got
+
+    :PARAM: number: Optional read to resume from the list, if there are several
+    """
+    interrupted = checkpoint.interrupted(_checkpoint_prefix())
+    assert interrupted, "There is no interrupted read to resume"
+    if not number and len(interrupted) > 1:
+        table = [["#", "Command", "Left off"]]
+        for i, saved in enumerate(interrupted, 1):
+            left_off = datetime.fromtimestamp(saved.path.stat().st_mtime)
+            table.append([i, saved, str(left_off).split(".")[0]])
+        message = tabulate(table, headers="firstrow", tablefmt="simple")
+        message += (
+            "\n\nResume one with: resume <#>, or discard it with: resume clear <#>"
+        )
+        message_dialog(title="Interrupted reads", text=message)
+        return
+    assert (
+        0 <= number <= len(interrupted)
+    ), f"{number} is not in the list of {len(interrupted)} interrupted reads"
+    saved = interrupted[max(number, 1) - 1]
+    if not saved.command.startswith("scan"):
+        assert ctmodbus.session, "There is not an open session.  Connect to one first."
+    command, _ = ctmodbus.commands.extract(saved.command)
+    with checkpoint.resuming(saved):
+        return command.execute(**saved.kwargs)
+
+
+@ctmodbus.command
+def do_resume_clear(number: int = 0):
+    """
+    Discard interrupted reads and scans, so resume no longer offers them
+
+    :PARAM: number: Optional read to discard from the resume list (default all)
+    """
+    interrupted = checkpoint.interrupted(_checkpoint_prefix())
+    assert interrupted, "There is no interrupted read to discard"
+    assert (
+        0 <= number <= len(interrupted)
+    ), f"{number} is not in the list of {len(interrupted)} interrupted reads"
+    discard = interrupted[number - 1 : number] if number else interrupted
+    for saved in discard:
+        saved.path.unlink(missing_ok=True)
+    return ctmodbus.output_text + f"Discarded {len(discard)} interrupted reads\n"
+
+
+@ctmodbus.command
+def do_poll():
+    """Various modbus poll functions..."""
+
+
+@ctmodbus.command
+def do_poll_discreteInputs(
+    csr: str, interval: float = 1, count: int = 10, max: int = 2000
+):
+    """
+    Repeatedly read discrete inputs (on/off) in format: 30,50,70-99,105
+
+    :PARAM: csr: Comma separated ranges to read
+    :PARAM: interval: Optional seconds between each read (default 1)
+    :PARAM: count: Optional number of times to read (default 10)
+    :PARAM: max: Optional max addresses to read per request (default 2000)
+    """
+    assert ctmodbus.session, "There is not an open session.  Connect to one first."
+    _validate_csr(csr, max)
+    read = ctmodbus.session.read_discrete_inputs
+    return _poll(
+        lambda: _read_bits("(2) Poll DisIn", 2, read, csr, max), interval, count
+    )
+
+
+@ctmodbus.command
+def do_poll_coils(csr: str, interval: float = 1, count: int = 10, max: int = 2000):
+    """
+    Repeatedly read coils (digital outputs and internal boolean tags)
+
+    :PARAM: csr: Comma separated ranges to read
+    :PARAM: interval: Optional seconds between each read (default 1)
+    :PARAM: count: Optional number of times to read (default 10)
+    :PARAM: max: Optional max addresses to read per request (default 2000)
+    """
+    assert ctmodbus.session, "There is not an open session.  Connect to one first."
+    _validate_csr(csr, max)
+    read = ctmodbus.session.read_coils
+    return _poll(
+        lambda: _read_bits("(1) Poll Coils", 1, read, csr, max), interval, count
+    )
+
+
+@ctmodbus.command
+def do_poll_inputRegisters(
+    csr: str, interval: float = 1, count: int = 10, max: int = 125
+):
+    """
+    Repeatedly read input registers (analog inputs) in format: 30,50,70-99,105
+
+    :PARAM: csr: Comma separated ranges to read
+    :PARAM: interval: Optional seconds between each read (default 1)
+    :PARAM: count: Optional number of times to read (default 10)
+    :PARAM: max: Optional max addresses to read per request (default 125)
+    """
+    assert ctmodbus.session, "There is not an open session.  Connect to one first."
+    _validate_csr(csr, max)
+    read = ctmodbus.session.read_input_registers
+    return _poll(
+        lambda: _read_words("(4) Poll InReg", 4, read, csr, max), interval, count
+    )
+
+
+@ctmodbus.command
+def do_poll_holdingRegisters(
+    csr: str, interval: float = 1, count: int = 10, max: int = 125
+):
+    """
+    Repeatedly read holding registers (analog outputs and internal tags)
+
+    :PARAM: csr: Comma separated ranges to read
+    :PARAM: interval: Optional seconds between each read (default 1)
+    :PARAM: count: Optional number of times to read (default 10)
+    :PARAM: max: Optional max addresses to read per request (default 125)
+    """
+    assert ctmodbus.session, "There is not an open session.  Connect to one first."
+    _validate_csr(csr, max)
+    read = ctmodbus.session.read_holding_registers
+    return _poll(
+        lambda: _read_words("(3) Poll HoReg", 3, read, csr, max), interval, count
+    )
+
+
+def _start_export(fmt, filename):
+    """Open a new export file that read and poll results stream into"""
+    assert ctmodbus.export == None, "Export already open.  Close first."
+    ctmodbus.export = export.Exporter(filename, fmt)
+    filename = ctmodbus.export.filename
+    date, time = str(datetime.today()).split()
+    return (
+        ctmodbus.output_text
+        + f"{fmt.upper()} export OPENED to {filename} at {date} {time}\n"
+    )
+
+
+@ctmodbus.command
+def do_export():
+    """Stream read and poll results to a file as they arrive"""
+    message_dialog(title="Export", text=f"Current export: {ctmodbus.export}")
+
+
+@ctmodbus.command
+def do_export_csv(filename: str):
+    """
+    Stream read and poll results to a CSV file, one row per address
+
+    :PARAM: filename: File to write results to
+    """
+    return _start_export("csv", filename)
+
+
+@ctmodbus.command
+def do_export_jsonl(filename: str):
+    """
+    Stream read and poll results to a JSON Lines file, one line per response
+
+    :PARAM: filename: File to write results to
+    """
+    return _start_export("jsonl", filename)
+
+
+@ctmodbus.command
+def do_export_npy(filename: str):
+    """
+    Stream read and poll results to a NumPy .npy file, loadable with mmap_mode
+
+    :PARAM: filename: File to write results to
+    """
+    return _start_export("npy", filename)
+
+
+@ctmodbus.command
+def do_export_close():
+    """
+    Close the open export file
+    """
+    assert ctmodbus.export, "There is not an open export.  Start one first."
+    running = ctmodbus.jobs.running
+    assert not running, f"Job {running[0].id} is still running.  Cancel it first."
+    ctmodbus.export.close()
+    records = ctmodbus.export.records
+    ctmodbus.export = None
+    return ctmodbus.output_text + f"Export CLOSED after {records} records\n"
+
+
+@ctmodbus.command
+def do_historian():
+    """Stream read and poll results to a historian service"""
+    assert ctmodbus.historian, "There is not an open historian.  Connect to one first."
+    message = tabulate(ctmodbus.historian.metrics.items(), tablefmt="plain")
+    message_dialog(title="Historian", text=message)
+
+
+@ctmodbus.command
+def do_historian_tcp(
+    host_port: str, policy: str = "drop", queue: int = 10000, batch: int = 500
+):
+    """
+    Stream read and poll results to a historian at <IP/HOSTNAME>[:<PORT>]
+
+    :PARAM: host_port: <IP/HOSTNAME>[:<PORT>] of the historian
+    :PARAM: policy: Optional drop oldest records or block when full (default drop)
+    :PARAM: queue: Optional max records waiting to be sent (default 10000)
+    :PARAM: batch: Optional max records per compressed batch (default 500)
+    """
+    assert ctmodbus.historian == None, "Historian already open.  Close first."
+    host, port = common.parse_ip_port(host_port)
+    h = historian.Historian(
+        host, port, policy=policy, queue_size=queue, batch_size=batch
+    )
+    if h.socket is None:
+        h.close(timeout=0)
+        raise AssertionError(f"Could not connect to {host}:{port}")
+    ctmodbus.historian = h
+    date, time = str(datetime.today()).split()
+    return (
+        ctmodbus.output_text + f"Historian OPENED with {host}:{port} at {date} {time}\n"
+    )
+
+
+@ctmodbus.command
+def do_historian_close():
+    """
+    Send what is still queued and close the historian connection
+    """
+    assert ctmodbus.historian, "There is not an open historian.  Connect to one first."
+    running = ctmodbus.jobs.running
+    assert not running, f"Job {running[0].id} is still running.  Cancel it first."
+    ctmodbus.historian.close()
+    sent, dropped = ctmodbus.historian.sent, ctmodbus.historian.dropped
+    ctmodbus.historian = None
+    return (
+        ctmodbus.output_text
+        + f"Historian CLOSED after {sent} records sent, {dropped} dropped\n"
+    )
+
+
+@ctmodbus.command
+def do_scan():
+    """Various modbus scans..."""
+
+
+@ctmodbus.command
+def do_scan_serial(
+    devices: str,
+    table: str,
+    csr: str,
+    units: str = "1",
+    method: str = "rtu",
+    timeout: float = 1,
+):
+    """
+    Read from several serial ports at once, each port on its own worker
+
+    :PARAM: devices: Comma separated serial devices or COM ports, or all
+    :PARAM: table: coils, discreteInputs, holdingRegisters or inputRegisters
+    :PARAM: csr: Comma separated ranges to read from each unit
+    :PARAM: units: Optional unit ids to sweep on each port, like 1-247 (default 1)
+    :PARAM: method: Optional rtu or ascii (default rtu)
+    :PARAM: timeout: Optional seconds to wait for each response (default 1)
+    """
+    assert table in snapshot.TABLES, f"{table} is not in: {', '.join(snapshot.TABLES)}"
+    assert method in ["rtu", "ascii"], "method must be rtu or ascii"
+    kwargs = dict(devices=devices, table=table, csr=csr, units=units)
+    kwargs.update(method=method, timeout=timeout)
+    if devices == "all":
+        devices = ",".join(port.device for port in common.serial_devices.get())
+    devices = [common.validate_serial_device(d) for d in devices.split(",") if d]
+    assert devices, "No serial devices to scan"
+    session_port = getattr(ctmodbus.session, "port", None)
+    assert session_port not in devices, f"{session_port} is in use.  Close first."
+    function = snapshot.TABLES.index(table) + 1
+    if function in (1, 2):
+        max, log_and_output = 2000, common.log_and_output_bits
+    else:
+        max, log_and_output = 125, common.log_and_output_words
+    _validate_csr(csr, max)
+    common.Loops(units, minimum=0, maximum=247)
+    started = monotonic()
+    with _checkpoint("scan serial", **kwargs) as saved:
+        scans = scan.scan_ports(
+            devices, method, function, csr, units, max, timeout, jobs.current(), saved
+        )
+    elapsed = monotonic() - started
+    output_text = ctmodbus.output_text
+    for port in scans:
+        for unit, results in port.results.items():
+            desc = f"({function}) Scan {port.device} unit {unit}"
+            addresses = sorted(results)
+            for first, stop in datatypes.contiguous_runs(addresses):
+                start, stop = addresses[first], addresses[stop - 1] + 1
+                output_text += log_and_output(desc, start, stop, results)
+    message = f"({function}) Scan {table}: {csr}\n\n"
+    common.summarize_scans(message, scans, elapsed)
+    return output_text
+
+
+def _open_connections(count):
+    """Open count connections to the device of the open session, like it"""
+    s = ctmodbus.session
+    if isinstance(s, ModbusSerialClient):
+        assert count == 1, "Serial devices only take one connection at a time"
+        return [s]
+    clients = []
+    for i in range(count):
+        if isinstance(s, tls.SessionTlsClient):
+            client = tls.SessionTlsClient(s.host, s.port, *s.files, timeout=s.timeout)
+        elif isinstance(s, udp.WindowedUdpClient):
+            client = udp.WindowedUdpClient(
+                s.host, s.port, window=s.window, retries=s.retries, timeout=s.timeout
+            )
+        else:
+            client = ModbusTcpClient(s.host, s.port, timeout=s.timeout)
+        clients.append(client)
+        if not client.connect():
+            for client in clients:
+                client.close()
+            raise AssertionError(
+                f"Could not open connection {i + 1} to {s.host}:{s.port}"
+            )
+    return clients
+
+
+@ctmodbus.command
+def do_loadtest(mix: str, connections: int = 1, rate: float = 0, duration: float = 10):
+    """
+    Measure how many reads per second the device handles, and how fast
+
+    :PARAM: mix: Reads to send, like 3:0-99*4,4:0-9 for function:start-stop*weight
+    :PARAM: connections: Optional connections, each with its own worker (default 1)
+    :PARAM: rate: Optional target requests per second, 0 for max (default 0)
+    :PARAM: duration: Optional seconds to run (default 10)
+    """
+    assert ctmodbus.session, "There is not an open session.  Connect to one first."
+    assert connections > 0, "connections must be at least 1"
+    assert rate >= 0 and duration > 0, "rate and duration can not be negative"
+    mix = loadtest.parse_mix(mix)
+    clients = _open_connections(connections)
+    test = loadtest.LoadTest(clients, mix, rate, duration, unit=unit_id)
+    try:
+        test.run()
+    finally:
+        for client in clients:
+            if client is not ctmodbus.session:
+                client.close()
+    output_text = ctmodbus.output_text
+    date, time = str(datetime.today()).split()
+    for second, requests, _, p50, _, p99, _, errors in test.intervals():
+        output_text += (
+            f"{date} {time} - Loadtest {second}s: {requests} req, "
+            f"p50 {p50 or '-'} ms, p99 {p99 or '-'} ms, {errors or '0.0%'} errors\n"
+        )
+    message = f"Loadtest {test}\n\n"
+    common.summarize_loadtest(message, test)
     return output_text
 
 
+@ctmodbus.command
+def do_bg(command: str):
+    """
+    Run a read, poll, scan or diff command as a background job
+
+    :PARAM: command: Quoted command line to run, like: "read holdingRegisters 0-999"
+    """
+    cmd, kwargs = ctmodbus.commands.extract(command)
+    assert cmd, f"{command} is not a valid command"
+    assert (
+        cmd.string.split()[0] in BACKGROUND
+    ), f"Only {', '.join(BACKGROUND)} commands can run in the background"
+    job = ctmodbus.jobs.start(command, lambda: cmd.execute(**kwargs))
+    return ctmodbus.output_text + f"Job {job.id} STARTED: {command}\n"
+
+
+@ctmodbus.command
+def do_jobs():
+    """List background jobs and their progress"""
+    table = [["Job", "Status", "Progress", "Command"]]
+    for job in ctmodbus.jobs:
+        table.append([job.id, job.status, job.progress, job.line])
+    message = tabulate(table, headers="firstrow", tablefmt="simple")
+    message_dialog(title="Jobs", text=message)
+
+
+@ctmodbus.command
+def do_jobs_cancel(id: int):
+    """
+    Stop a background job, keeping what it has read so far
+
+    :PARAM: id: Job number from the jobs list
+    """
+    job = ctmodbus.jobs[id]
+    assert job.running, f"Job {id} is already {job.status}"
+    job.cancel()
+    return ctmodbus.output_text + f"Job {id} CANCELLED: {job.line}\n"
+
+
+@ctmodbus.command
+def do_snapshot():
+    """Values captured by every read since the snapshot was cleared"""
+    message_dialog(title="Snapshot", text=f"Current snapshot: {ctmodbus.snapshot}")
+
+
+@ctmodbus.command
+def do_snapshot_save(filename: str):
+    """
+    Save every value read so far to a snapshot file for later diffs
+
+    :PARAM: filename: File to save the snapshot to
+    """
+    assert len(ctmodbus.snapshot), "Snapshot is empty.  Read something first."
+    path = ctmodbus.snapshot.save(filename)
+    date, time = str(datetime.today()).split()
+    return ctmodbus.output_text + f"Snapshot SAVED to {path} at {date} {time}\n"
+
+
+@ctmodbus.command
+def do_snapshot_clear():
+    """
+    Forget every value read so far
+    """
+    ctmodbus.snapshot = snapshot.Snapshot(ctmodbus.snapshot.source)
+    return ctmodbus.output_text + "Snapshot CLEARED\n"
+
+
+@ctmodbus.command
+def do_diff(old: str, new: str):
+    """
+    Compare two snapshot files and list the address ranges that changed
+
+    :PARAM: old: Snapshot file to compare from
+    :PARAM: new: Snapshot file to compare to
+    """
+    differences = snapshot.diff(
+        snapshot.Snapshot.load(old), snapshot.Snapshot.load(new)
+    )
+    common.summarize_diff(f"Diff: {old} {new}\n\n", differences)
+    date, time = str(datetime.today()).split()
+    return (
+        ctmodbus.output_text
+        + f"{date} {time} - Diff {old} {new}: {len(differences)} ranges\n"
+    )
+
+
+@ctmodbus.command
+def do_diff_device(old: str):
+    """
+    Re-read every address in a snapshot file from the device and compare
+
+    :PARAM: old: Snapshot file to compare the device to
+    """
+    assert ctmodbus.session, "There is not an open session.  Connect to one first."
+    old_snapshot = snapshot.Snapshot.load(old)
+    new_snapshot = snapshot.Snapshot(ctmodbus.snapshot.source)
+    reads = {
+        1: (_read_bits, ctmodbus.session.read_coils, 2000),
+        2: (_read_bits, ctmodbus.session.read_discrete_inputs, 2000),
+        3: (_read_words, ctmodbus.session.read_holding_registers, 125),
+        4: (_read_words, ctmodbus.session.read_input_registers, 125),
+    }
+    output_text = ctmodbus.output_text
+    for function, (read_csr, read, max) in reads.items():
+        csr = str(common.Loops.from_ranges(old_snapshot.ranges(function), 0, 65535))
+        if not csr:
+            continue
+        desc = f"({function}) Diff {snapshot.TABLES[function - 1]}"
+        results, text = read_csr(desc, function, read, csr, max)
+        new_snapshot.update_results(function, results)
+        output_text += text
+    differences = snapshot.diff(old_snapshot, new_snapshot)
+    common.summarize_diff(f"Diff: {old} device\n\n", differences)
+    date, time = str(datetime.today()).split()
+    return (
+        output_text + f"{date} {time} - Diff {old} device: {len(differences)} ranges\n"
+    )
+
+
 @ctmodbus.command
 def do_write():
     """Various modbus write commands..."""
@@ -337,8 +1283,69 @@ def do_write_coil(address: int, values: GreedyBin):
     return output_text
 
 
-def main():
-    ctmodbus.run()
+def _close_all():
+    """Close whatever a batch left open, sending what the historian holds"""
+    if ctmodbus.export:
+        ctmodbus.export.close()
+        ctmodbus.export = None
+    if ctmodbus.historian:
+        ctmodbus.historian.close()
+        ctmodbus.historian = None
+    if ctmodbus.session:
+        ctmodbus.session.close()
+        ctmodbus.session = None
+
+
+def main(argv=None):
+    """Start the terminal UI, or run commands from a script without it"""
+    parser = argparse.ArgumentParser(
+        prog="ctmodbus",
+        description=ctmodbus.description,
+        epilog="Without a script or -c, the interactive terminal UI starts.",
+    )
+    parser.add_argument(
+        "script", nargs="?", help="file of commands, one per line, or - for stdin"
+    )
+    parser.add_argument(
+        "-c",
+        "--command",
+        action="append",
+        default=[],
+        help="command to run before the script, can be repeated",
+    )
+    parser.add_argument(
+        "-f",
+        "--format",
+        choices=batch.FORMATS,
+        default="jsonl",
+        help="jsonl records or plain text (default jsonl)",
+    )
+    parser.add_argument(
+        "-k",
+        "--keep-going",
+        action="store_true",
+        help="run the rest of the commands after one fails",
+    )
+    args = parser.parse_args(argv)
+    if args.script is None and not args.command:
+        ctmodbus.run()
+        return
+    lines = list(args.command)
+    script = None
+    if args.script == "-":
+        script = sys.stdin
+    elif args.script:
+        script = open(args.script)
+    runner = batch.Batch(ctmodbus, fmt=args.format, keep_going=args.keep_going)
+    try:
+        status = runner.run(itertools.chain(lines, script or []))
+    except KeyboardInterrupt:
+        status = 130
+    finally:
+        _close_all()
+        if script and script is not sys.stdin:
+            script.close()
+    sys.exit(status)
 
 
 if __name__ == "__main__":
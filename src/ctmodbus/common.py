@@ -13,90 +13,216 @@ Control Things Modbus, aka ctmodbus.py
 # details at <http://www.gnu.org/licenses/>.
 """
 
+import itertools
 import operator
+import os
 import socket
+import threading
+from array import array
+from bisect import bisect_left, bisect_right
 from datetime import datetime
+from time import monotonic, sleep
 
-from ctui.dialogs import message_dialog
-from psutil import Process, net_connections
+import numpy as np
+from ctui import dialogs
+from psutil import CONN_LISTEN, AccessDenied, NoSuchProcess, Process, net_connections
 from serial.tools.list_ports import comports
 from tabulate import tabulate
 
+from ctmodbus import datatypes, jobs
+
+SERIAL_REFRESH = 5  # seconds between serial device enumerations
+DIFF_ROWS = 1000  # most ranges listed in the differences dialog
+_process_names = {}  # {pid: name} of listening processes
+
 
 class Loops(object):
-    """Object that contains and calculates a list of range parameters"""
+    """
+    Sorted address ranges parsed from comma separated values and ranges
+
+    Ranges are kept merged, so none overlap or touch, in two arrays of
+    starts and exclusive stops.  Specs with tens of thousands of fragments
+    stay compact, membership and append take O(log n) with bisect, and
+    union, intersection and difference work on whole arrays at once.
+    """
 
     from sys import maxsize
 
+    __slots__ = ["csr", "minimum", "maximum", "_starts", "_stops"]
+
     def __init__(self, csr=None, minimum=-maxsize, maximum=maxsize):
         assert isinstance(csr, str) or csr == None, "csr must be a string"
         self.csr = csr or None
-        self.loops = []
-        self.length = 0
-        self.enum_length = 0
+        self.minimum = minimum
+        self.maximum = maximum
+        self._starts = array("q")
+        self._stops = array("q")  # exclusive
         if csr:
             self._from_int_csr(csr, minimum, maximum)
 
     def __repr__(self):
-        return repr(self.loops)
+        return "Loops('{}')".format(self)
+
+    def __str__(self):
+        """Merged ranges as comma separated values and ranges, like 1-5,10"""
+        return ",".join(
+            str(start) if stop - start == 1 else "{}-{}".format(start, stop - 1)
+            for start, stop in zip(self._starts, self._stops)
+        )
 
     def __len__(self):
-        return self.length
+        return len(self._starts)
 
     def __iter__(self):
-        for loop in self.loops:
-            yield loop
+        for start, stop in zip(self._starts, self._stops):
+            yield {"start": start, "stop": stop, "count": stop - start}
+
+    def __contains__(self, address):
+        i = bisect_right(self._starts, address) - 1
+        return i >= 0 and address < self._stops[i]
+
+    def __eq__(self, other):
+        if not isinstance(other, Loops):
+            return NotImplemented
+        return self._starts == other._starts and self._stops == other._stops
+
+    def __or__(self, other):
+        return self.union(other)
+
+    def __and__(self, other):
+        return self.intersection(other)
+
+    def __sub__(self, other):
+        return self.difference(other)
+
+    @property
+    def length(self):
+        """Number of ranges"""
+        return len(self._starts)
+
+    @property
+    def enum_length(self):
+        """Number of addresses in all ranges"""
+        starts, stops = self._arrays()
+        return int((stops - starts).sum())
+
+    @classmethod
+    def from_ranges(cls, ranges, minimum=-maxsize, maximum=maxsize):
+        """
+        Build from (start, stop) pairs, merging any that overlap or touch
+
+        :PARAM: ranges: Iterable of (start, stop) with exclusive stop
+        :PARAM: minimum: Lowest address allowed
+        :PARAM: maximum: Highest address allowed
+        """
+        pairs = np.array(list(ranges), dtype=np.int64).reshape(-1, 2)
+        assert (pairs[:, 0] < pairs[:, 1]).all(), "every start must be below its stop"
+        assert (pairs[:, 0] >= minimum).all() and (
+            pairs[:, 1] - 1 <= maximum
+        ).all(), "ranges must be between {} and {}".format(minimum, maximum)
+        loops = cls(minimum=minimum, maximum=maximum)
+        loops._set_arrays(*_merge_ranges(pairs[:, 0], pairs[:, 1]))
+        return loops
 
     def max_count(self, max_count):
         assert isinstance(max_count, int), "max_count must be int"
-        for loop in self.loops:
-            for i in range(0, loop["count"], max_count):
-                start, stop, count = loop.values()
+        for start, stop in zip(self._starts, self._stops):
+            for i in range(start, stop, max_count):
                 yield {
-                    "start": start + i,
-                    "stop": min(start + max_count + i, stop),
-                    "count": min(max_count, count - i),
+                    "start": i,
+                    "stop": min(i + max_count, stop),
+                    "count": min(max_count, stop - i),
                 }
 
     def append(self, start, stop=None, count=None):
-        """Append a new loop"""
+        """Add a range, merging it with any it overlaps or touches"""
         assert isinstance(start, int), "start must be an int"
-        assert stop or count, "must set stop or count"
-        if stop and not count:
+        assert stop is not None or count is not None, "must set stop or count"
+        if count is None:
             count = stop - start + 1
-        elif count and not stop:
+        elif stop is None:
             stop = start + count - 1
         assert count == stop - start + 1, "count must equal stop - start + 1"
-        self.loops.append({"start": start, "stop": stop, "count": count})
-        self.length += 1
-        self.enum_length += count
+        assert count > 0, "count must be at least 1"
+        stop += 1
+        # ranges from i up to j overlap or touch the new one
+        i = bisect_left(self._stops, start)
+        j = bisect_right(self._starts, stop)
+        if i < j:
+            start = min(start, self._starts[i])
+            stop = max(stop, self._stops[j - 1])
+        self._starts[i:j] = array("q", [start])
+        self._stops[i:j] = array("q", [stop])
 
     def enum(self, func=None):
         """Use ranges to enumerate every increment"""
-        for loop in self.loops:
-            for x in range(loop["start"], loop["stop"]):
-                if func:
-                    yield func(x)
-                else:
-                    yield x
+        addresses = itertools.chain.from_iterable(map(range, self._starts, self._stops))
+        return map(func, addresses) if func else addresses
+
+    def addresses(self):
+        """Every address in the ranges, as one numpy array"""
+        starts, stops = self._arrays()
+        counts = stops - starts
+        offsets = np.arange(counts.sum()) - np.repeat(
+            np.cumsum(counts) - counts, counts
+        )
+        return np.repeat(starts, counts) + offsets
+
+    def union(self, other):
+        """Addresses in either"""
+        return self._combine(other, np.logical_or)
+
+    def intersection(self, other):
+        """Addresses in both, like the parts of a spec known to be valid"""
+        return self._combine(other, np.logical_and)
+
+    def difference(self, other):
+        """Addresses in this but not in other, like the ones not read yet"""
+        return self._combine(other, lambda a, b: a & ~b)
+
+    def _combine(self, other, keep):
+        assert isinstance(other, Loops), "can only combine Loops with Loops"
+        starts, stops = self._arrays()
+        other_starts, other_stops = other._arrays()
+        # every boundary of both splits the line into pieces that are either
+        # entirely in or entirely out of each, so keep decides piece by piece
+        points = np.sort(np.concatenate([starts, stops, other_starts, other_stops]))
+        distinct = np.ones(len(points), dtype=bool)
+        distinct[1:] = points[1:] != points[:-1]
+        points = points[distinct]
+        pieces = points[:-1]
+        kept = keep(
+            _covered(starts, stops, pieces), _covered(other_starts, other_stops, pieces)
+        )
+        loops = Loops(minimum=self.minimum, maximum=self.maximum)
+        loops._set_arrays(*_merge_ranges(pieces[kept], points[1:][kept]))
+        return loops
+
+    def _arrays(self):
+        """Starts and stops as numpy arrays sharing memory with the loops"""
+        return (
+            np.frombuffer(self._starts, dtype=np.int64),
+            np.frombuffer(self._stops, dtype=np.int64),
+        )
+
+    def _set_arrays(self, starts, stops):
+        self._starts = array("q", starts.astype(np.int64).tobytes())
+        self._stops = array("q", stops.astype(np.int64).tobytes())
 
     def _from_int_csr(self, csr, minimum, maximum):
-        """Converts comma separated int ranges to range() functions"""
+        """Converts comma separated int ranges to sorted merged ranges"""
         assert isinstance(csr, str), 'csr must be a string like "1-5,10,13-15"'
         assert isinstance(minimum, int), "minimum must be int"
-        self.minimum = minimum
         assert isinstance(maximum, int), "maximum must be int"
-        self.maximum = maximum
-        parts = csr.split(",")
-        for single_or_range in parts:
+        starts, stops = [], []
+        for single_or_range in csr.split(","):
             if single_or_range.isdigit():
                 single = int(single_or_range)
                 assert (
                     minimum <= single <= maximum
                 ), "{} is not between {} and {}".format(single, minimum, maximum)
-                self.loops.append({"start": single, "stop": single + 1, "count": 1})
-                self.length += 1
-                self.enum_length += 1
+                starts.append(single)
+                stops.append(single + 1)
             else:
                 a_range = single_or_range.split("-")
                 assert len(a_range) == 2, "{} is not a valid range".format(a_range)
@@ -112,10 +238,85 @@ class Loops(object):
                     stop, minimum, maximum
                 )
                 assert start < stop, "{} must be less than {}".format(start, stop)
-                count = stop - start + 1
-                self.loops.append({"start": start, "stop": stop + 1, "count": count})
-                self.length += 1
-                self.enum_length += count
+                starts.append(start)
+                stops.append(stop + 1)
+        self._set_arrays(
+            *_merge_ranges(
+                np.array(starts, dtype=np.int64), np.array(stops, dtype=np.int64)
+            )
+        )
+
+
+def _covered(starts, stops, addresses):
+    """Boolean array of which addresses fall in the sorted, merged ranges"""
+    if not len(starts):
+        return np.zeros(len(addresses), dtype=bool)
+    i = np.searchsorted(starts, addresses, side="right") - 1
+    return (i >= 0) & (addresses < stops[i.clip(0)])
+
+
+def _merge_ranges(starts, stops):
+    """Sort ranges by start and merge the ones that overlap or touch"""
+    if not len(starts):
+        return starts, stops
+    order = np.argsort(starts, kind="stable")
+    starts = starts[order]
+    ends = np.maximum.accumulate(stops[order])  # furthest stop so far
+    first = np.ones(len(starts), dtype=bool)
+    first[1:] = starts[1:] > ends[:-1]
+    last = np.append(np.flatnonzero(first)[1:] - 1, len(starts) - 1)
+    return starts[first], ends[last]
+
+
+class SerialDevices(object):
+    """
+    Serial devices found by comports(), enumerated again on a timer
+
+    Enumerating serial ports can take a second or more on some hosts, so
+    once first asked for, a daemon thread enumerates them every refresh
+    seconds and lookups read the last list.
+    """
+
+    def __init__(self, refresh=SERIAL_REFRESH):
+        self.refresh = refresh  # seconds between enumerations
+        self.ports = None  # sorted list of serial.tools ListPortInfo
+        self.updated = None
+        self.thread = None
+        self.lock = threading.Lock()
+
+    def get(self, fresh=False):
+        """
+        Devices from the last enumeration, enumerating first if there is none
+
+        :PARAM: fresh: Enumerate now instead of using the last list
+        """
+        if fresh or self.ports is None:
+            self._enumerate()
+        with self.lock:
+            if self.thread is None:
+                self.thread = threading.Thread(target=self._refresh, daemon=True)
+                self.thread.start()
+            return self.ports
+
+    def _enumerate(self):
+        """Enumerate outside the lock, so lookups never wait on comports()"""
+        started = monotonic()
+        ports = sorted(comports(), key=operator.attrgetter("device"))
+        with self.lock:
+            if self.updated is None or started > self.updated:  # newest list wins
+                self.ports = ports
+                self.updated = started
+
+    def _refresh(self):
+        while True:
+            sleep(self.refresh)
+            try:
+                self._enumerate()
+            except Exception:
+                pass  # keep the last list until the next try
+
+
+serial_devices = SerialDevices()
 
 
 def validate_serial_device(device):
@@ -124,54 +325,105 @@ def validate_serial_device(device):
 
     :PARAM: device: A device file path or comm port
     """
-    devices = [x.device for x in comports()]
-    assert device in devices, "{} is not in: \n{} ".format(
+    devices = [x.device for x in serial_devices.get()]
+    if device not in devices:  # plugged in since the last enumeration?
+        devices = [x.device for x in serial_devices.get(fresh=True)]
+    # pseudo terminals, like socat test pairs, are not listed by comports()
+    assert device in devices or _is_terminal(device), "{} is not in: \n{} ".format(
         device, list_serial_devices()
     )
     return device
 
 
+def _is_terminal(device):
+    """Whether device opens as a terminal, unlike /dev/null or other devices"""
+    try:
+        fd = os.open(device, os.O_RDWR | os.O_NOCTTY | os.O_NONBLOCK)
+    except OSError:
+        return False
+    try:
+        return os.isatty(fd)
+    finally:
+        os.close(fd)
+
+
 def list_serial_devices():
     headers = ["DEVICE", "MANUFACTURER", "PRODUCT ID"]
     rows = []
-    for dev in comports():
+    for dev in serial_devices.get():
         columns = []
         columns.append(dev.device)
         columns.append(dev.manufacturer)
         columns.append(dev.product)
         rows.append(columns)
-    table = sorted(rows, key=operator.itemgetter(0))
-    return tabulate(table, headers=headers, tablefmt="fancy_grid")
+    return tabulate(rows, headers=headers, tablefmt="fancy_grid")
+
 
+def listening_ports(ports=None):
+    """
+    Sorted (ip, port, pid) of local TCP listeners
+
+    :PARAM: ports: Loops of ports to keep, or None to keep every listener
+    """
+    listeners = set()
+    for conn in net_connections(kind="tcp"):
+        if conn.status == CONN_LISTEN:
+            if ports is None or conn.laddr.port in ports:
+                listeners.add((conn.laddr.ip, conn.laddr.port, conn.pid))
+    return sorted(listeners, key=lambda listener: (listener[1], listener[0]))
 
-def list_listening_ports():
-    conns = net_connections()
+
+def process_name(pid):
+    """
+    Name of process pid, cached as each lookup reads from /proc
+
+    :PARAM: pid: Process id, or None when it is not known
+    """
+    if not pid:
+        return ""
+    if pid not in _process_names:
+        try:
+            _process_names[pid] = Process(pid).name()
+        except (NoSuchProcess, AccessDenied):
+            _process_names[pid] = ""
+    return _process_names[pid]
+
+
+def list_listening_ports(listeners=None, probes=None):
+    """
+    Table of local TCP listeners and the processes behind them
+
+    :PARAM: listeners: (ip, port, pid) from listening_ports(), or None for all
+    :PARAM: probes: Optional {(ip, port): result} of Modbus probes to add
+    """
+    if listeners is None:
+        listeners = listening_ports()
     headers = ["IP", "PORT", "PROCESS"]
+    if probes is not None:
+        headers.append("MODBUS")
     rows = []
-    for conn in conns:
-        if conn[5] == "LISTEN":
-            collumns = []
-            collumns.append(conn[3][0])
-            collumns.append(conn[3][1])
-            if conn[6]:
-                process = Process(conn[6])
-                collumns.append(process.name())
-            else:
-                collumns.append("")
-            rows.append(collumns)
-    table = sorted(rows, key=operator.itemgetter(1))
-    return tabulate(table, headers=headers, tablefmt="fancy_grid")
+    for ip, port, pid in listeners:
+        columns = [ip, port, process_name(pid)]
+        if probes is not None:
+            columns.append(probes.get((ip, port), ""))
+        rows.append(columns)
+    # forget processes that stopped listening, as their pids may be reused
+    pids = {pid for _, _, pid in listeners}
+    for pid in set(_process_names) - pids:
+        del _process_names[pid]
+    return tabulate(rows, headers=headers, tablefmt="fancy_grid")
 
 
-def parse_ip_port(ip_port):
+def parse_ip_port(ip_port, default_port=502):
     """
     Separate ip/host and port from unified address
 
     :PARAM: ip_port: Any address in ip or ip:port format
+    :PARAM: default_port: Port to use when ip_port has none
     """
     parts = ip_port.rsplit(":", 1)
     host = parts[0]
-    port = 502
+    port = default_port
     if len(parts) == 2:
         port = int(parts[1])
     return host, port
@@ -219,6 +471,19 @@ def log_and_output_words(desc, start, stop, results):
     return output_text
 
 
+def message_dialog(**kwargs):
+    """
+    Show a message dialog, or hold it until the background job calling it ends
+
+    :PARAM: kwargs: Arguments for ctui.dialogs.message_dialog
+    """
+    job = jobs.current()
+    if job:
+        job.dialogs.append(kwargs)
+    else:
+        dialogs.message_dialog(**kwargs)
+
+
 def summarize_bit_responses(message, results):
     """
     Summarize bit responses in message dialog
@@ -281,6 +546,111 @@ def summarize_word_responses(message, results):
     message_dialog(title="Success", text=message)
 
 
+def summarize_decoded_responses(message, results, datatype, order):
+    """
+    Summarize word responses decoded as datatype in message dialog
+
+    :PARAM:
+    """
+    decoded = datatypes.decode_results(results, datatype, order)
+    assert decoded, "Not enough contiguous registers to decode {}".format(datatype)
+    width = datatypes.DATATYPES[datatype][1]
+    table = [["Addr", "{} ({})".format(datatype, order.upper())]]
+    la, lr, fa = None, None, None  # last_addres, last_result, first_address
+    for address, result in decoded:
+        if datatype != "string" and address - width == la and result == lr:
+            if fa == None:
+                fa = la
+        elif la != None:
+            if fa == None:
+                table.append([la, lr])
+            else:
+                table.append(["{0}-{1}".format(fa, la), lr])
+                fa = None
+        la, lr = address, result
+    # Print final output from for loop
+    if fa == None:
+        table.append([la, lr])
+    else:
+        table.append(["{0}-{1}".format(fa, la), lr])
+    message += tabulate(table, headers="firstrow", tablefmt="simple")
+    message_dialog(title="Success", text=message)
+
+
+def summarize_diff(message, differences):
+    """
+    Summarize snapshot differences in message dialog
+
+    :PARAM:
+    """
+    rows = differences.rows(DIFF_ROWS)
+    table = [["Table", "Addr", "Status", "Old", "New"]] + rows
+    if not rows:
+        message += "No differences found"
+    else:
+        message += tabulate(table, headers="firstrow", tablefmt="simple")
+    if len(differences) > len(rows):
+        message += "\n\nShowing the first {} of {} ranges".format(
+            len(rows), len(differences)
+        )
+    message_dialog(title="Differences", text=message, scrollbar=len(rows) > 20)
+
+
+def summarize_scans(message, scans, elapsed):
+    """
+    Summarize per port results and timing of a serial scan in message dialog
+
+    :PARAM:
+    """
+    table = [
+        [
+            "Device",
+            "Units",
+            "Requests",
+            "Refused",
+            "Errors",
+            "Seconds",
+            "Req/s",
+            "Error",
+        ]
+    ]
+    for scan in scans:
+        rate = scan.requests / scan.elapsed if scan.elapsed else 0
+        units = ",".join(str(unit) for unit in scan.results)
+        table.append(
+            [
+                scan.device,
+                units,
+                scan.requests,
+                scan.refused,
+                scan.errors,
+                "{:.2f}".format(scan.elapsed),
+                "{:.1f}".format(rate),
+                scan.error or "",
+            ]
+        )
+    message += tabulate(table, headers="firstrow", tablefmt="simple")
+    serial_time = sum(scan.elapsed for scan in scans)
+    message += "\n\n{:.2f} seconds total, {:.2f} seconds if scanned one by one".format(
+        elapsed, serial_time
+    )
+    message_dialog(title="Success", text=message)
+
+
+def summarize_loadtest(message, test):
+    """
+    Summarize throughput, latency and errors of a load test in message dialog
+
+    :PARAM:
+    """
+    message += tabulate(test.summary().items(), tablefmt="plain")
+    rows = test.intervals()
+    table = [["Second", "Requests", "Req/s", "p50 ms", "p90 ms", "p99 ms", "Max ms"]]
+    table[0].append("Errors")
+    message += "\n\n" + tabulate(table + rows, headers="firstrow", tablefmt="simple")
+    message_dialog(title="Load test", text=message, scrollbar=len(rows) > 10)
+
+
 def csr_to_ranges(csr, max):
     """
     Generator to convert csr to ranges
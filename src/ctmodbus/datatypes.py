@@ -0,0 +1,127 @@
+"""
+Control Things Modbus, aka ctmodbus.py
+
+# Copyright (C) 2019  Justin Searle
+#
+# This program is free software: you can redistribute it and/or modify it under
+# the terms of the GNU General Public License as published by the Free Software
+# Foundation, either version 3 of the License, or any later version.
+#
+# This program is distributed in the hope that it will be useful, but WITHOUT
+# ANY WARRANTY; without even the implied warranty of MERCHANTABILITY or FITNESS
+# FOR A PARTICULAR PURPOSE.  See the GNU General Public License for more
+# details at <http://www.gnu.org/licenses/>.
+"""
+
+import numpy as np
+
+# datatype: (numpy type code, registers per value)
+DATATYPES = {
+    "int16": ("i2", 1),
+    "uint16": ("u2", 1),
+    "int32": ("i4", 2),
+    "uint32": ("u4", 2),
+    "float32": ("f4", 2),
+    "int64": ("i8", 4),
+    "uint64": ("u8", 4),
+    "float64": ("f8", 4),
+    "string": ("S", 1),
+}
+
+# byte order named after the order of bytes "ABCD" as they appear on the wire
+# order: (swap bytes inside each register, swap register order inside each value)
+ORDERS = {
+    "abcd": (False, False),  # big endian, the Modbus default
+    "badc": (True, False),  # byte swap
+    "cdab": (False, True),  # word swap
+    "dcba": (True, True),  # little endian
+}
+
+
+def validate_datatype(datatype, order="abcd"):
+    """
+    Verify requested datatype and byte order are supported
+
+    :PARAM: datatype: One of the names in DATATYPES
+    :PARAM: order: One of the names in ORDERS
+    """
+    datatype, order = datatype.lower(), order.lower()
+    assert datatype in DATATYPES, "{} is not in: {}".format(
+        datatype, ", ".join(DATATYPES)
+    )
+    assert order in ORDERS, "{} is not in: {}".format(order, ", ".join(ORDERS))
+    return datatype, order
+
+
+def registers_to_bytes(registers, order="abcd", width=1):
+    """
+    Reinterpret a whole register array as raw bytes in the requested order
+
+    :PARAM: registers: Sequence or array of 16 bit register values
+    :PARAM: order: One of the names in ORDERS
+    :PARAM: width: Registers per value, trailing registers that do not fill
+        a whole value are dropped
+    """
+    byte_swap, word_swap = ORDERS[order]
+    words = np.asarray(registers, dtype=np.uint16)
+    words = words[: len(words) - len(words) % width].reshape(-1, width)
+    if word_swap:
+        words = words[:, ::-1]
+    wire = np.ascontiguousarray(words, dtype="<u2" if byte_swap else ">u2")
+    return wire.view(np.uint8).ravel()
+
+
+def decode_registers(registers, datatype="uint16", order="abcd"):
+    """
+    Decode a whole register array at once into an array of datatype
+
+    :PARAM: registers: Sequence or array of 16 bit register values
+    :PARAM: datatype: One of the names in DATATYPES
+    :PARAM: order: One of the names in ORDERS
+    """
+    datatype, order = validate_datatype(datatype, order)
+    code, width = DATATYPES[datatype]
+    raw = registers_to_bytes(registers, order, width)
+    if datatype == "string":
+        return raw.tobytes().decode("utf-8", errors="replace").strip("\x00")
+    return raw.view(">" + code)
+
+
+def contiguous_runs(addresses):
+    """
+    Split sorted addresses into (first index, stop index) of contiguous runs
+
+    :PARAM: addresses: Sorted array of addresses
+    """
+    addresses = np.asarray(addresses)
+    if not len(addresses):
+        return []
+    breaks = np.flatnonzero(np.diff(addresses) != 1) + 1
+    firsts = np.concatenate(([0], breaks))
+    stops = np.concatenate((breaks, [len(addresses)]))
+    return list(zip(firsts.tolist(), stops.tolist()))
+
+
+def decode_results(results, datatype="uint16", order="abcd"):
+    """
+    Decode each contiguous run of a results dict, returning (address, value)
+
+    :PARAM: results: Dict of {address: register} as built by the read commands
+    :PARAM: datatype: One of the names in DATATYPES
+    :PARAM: order: One of the names in ORDERS
+    """
+    datatype, order = validate_datatype(datatype, order)
+    width = DATATYPES[datatype][1]
+    addresses = np.fromiter(results.keys(), dtype=np.int64, count=len(results))
+    registers = np.fromiter(results.values(), dtype=np.uint16, count=len(results))
+    order_by = np.argsort(addresses, kind="stable")
+    addresses, registers = addresses[order_by], registers[order_by]
+    decoded = []
+    for first, stop in contiguous_runs(addresses):
+        values = decode_registers(registers[first:stop], datatype, order)
+        if datatype == "string":
+            decoded.append((int(addresses[first]), values))
+            continue
+        starts = addresses[first:stop:width][: len(values)]
+        decoded.extend(zip(starts.tolist(), values.tolist()))
+    return decoded
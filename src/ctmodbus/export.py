@@ -0,0 +1,111 @@
+"""
+Control Things Modbus, aka ctmodbus.py
+
+# Copyright (C) 2019  Justin Searle
+#
+# This program is free software: you can redistribute it and/or modify it under
+# the terms of the GNU General Public License as published by the Free Software
+# Foundation, either version 3 of the License, or any later version.
+#
+# This program is distributed in the hope that it will be useful, but WITHOUT
+# ANY WARRANTY; without even the implied warranty of MERCHANTABILITY or FITNESS
+# FOR A PARTICULAR PURPOSE.  See the GNU General Public License for more
+# details at <http://www.gnu.org/licenses/>.
+"""
+
+import csv
+import json
+import threading
+import time
+from datetime import datetime
+from pathlib import Path
+
+import numpy as np
+
+# One record per address, the dtype of exported .npy files
+RECORD_DTYPE = np.dtype(
+    [("time", "<f8"), ("function", "u1"), ("address", "<u2"), ("value", "<u2")]
+)
+NPY_HEADER_LEN = 192  # fixed so the final shape can be written in place
+
+
+class Exporter(object):
+    """Streams read results to a file as each chunk arrives"""
+
+    formats = ["csv", "jsonl", "npy"]
+
+    def __init__(self, filename, fmt):
+        assert fmt in self.formats, "{} is not in: {}".format(
+            fmt, ", ".join(self.formats)
+        )
+        self.filename = str(Path(filename).expanduser())
+        self.format = fmt
+        self.records = 0
+        self.lock = threading.Lock()  # background jobs write from their threads
+        if fmt == "npy":
+            self.file = open(self.filename, "wb")
+            self.file.write(self._npy_header())
+        elif fmt == "csv":
+            self.file = open(self.filename, "w", newline="")
+            self.writer = csv.writer(self.file)
+            self.writer.writerow(["timestamp", "function", "address", "value"])
+        else:
+            self.file = open(self.filename, "w")
+
+    def __repr__(self):
+        return "{} {} ({} records)".format(self.format, self.filename, self.records)
+
+    def write(self, function, start, values):
+        """
+        Write one chunk of results straight through to the file
+
+        :PARAM: function: Modbus function code that produced the values
+        :PARAM: start: Address of the first value
+        :PARAM: values: List of int values, one per address
+        """
+        now = time.time()
+        with self.lock:
+            if self.format == "csv":
+                timestamp = datetime.fromtimestamp(now).isoformat()
+                self.writer.writerows(
+                    [timestamp, function, start + i, value]
+                    for i, value in enumerate(values)
+                )
+            elif self.format == "jsonl":
+                record = {
+                    "timestamp": datetime.fromtimestamp(now).isoformat(),
+                    "function": function,
+                    "start": start,
+                    "values": list(values),
+                }
+                self.file.write(json.dumps(record) + "\n")
+            else:
+                chunk = np.empty(len(values), dtype=RECORD_DTYPE)
+                chunk["time"] = now
+                chunk["function"] = function
+                chunk["address"] = np.arange(start, start + len(values))
+                chunk["value"] = values
+                chunk.tofile(self.file)
+            self.records += len(values)
+            if self.format == "npy":
+                # keep the header shape current so the file loads even mid-capture
+                self.file.seek(0)
+                self.file.write(self._npy_header())
+                self.file.seek(0, 2)
+            self.file.flush()
+
+    def close(self):
+        """Close the export file"""
+        with self.lock:
+            self.file.close()
+
+    def _npy_header(self):
+        """Version 1.0 .npy header padded to NPY_HEADER_LEN bytes"""
+        header = "{{'descr': {!r}, 'fortran_order': False, 'shape': ({},), }}".format(
+            np.lib.format.dtype_to_descr(RECORD_DTYPE), self.records
+        )
+        preamble = b"\x93NUMPY\x01\x00"
+        pad = NPY_HEADER_LEN - len(preamble) - 2 - len(header) - 1
+        assert pad >= 0, "npy header too long"
+        header = header + " " * pad + "\n"
+        return preamble + len(header).to_bytes(2, "little") + header.encode("latin1")
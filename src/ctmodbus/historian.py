@@ -0,0 +1,219 @@
+"""
+Control Things Modbus, aka ctmodbus.py
+
+# Copyright (C) 2019  Justin Searle
+#
+# This program is free software: you can redistribute it and/or modify it under
+# the terms of the GNU General Public License as published by the Free Software
+# Foundation, either version 3 of the License, or any later version.
+#
+# This program is distributed in the hope that it will be useful, but WITHOUT
+# ANY WARRANTY; without even the implied warranty of MERCHANTABILITY or FITNESS
+# FOR A PARTICULAR PURPOSE.  See the GNU General Public License for more
+# details at <http://www.gnu.org/licenses/>.
+"""
+
+import json
+import socket
+import struct
+import threading
+import zlib
+from collections import deque
+from datetime import datetime
+from time import monotonic, sleep
+
+from ctmodbus import jobs
+
+CANCEL_CHECK = 0.1  # seconds between checks for a cancelled job while blocked
+
+
+class Historian(object):
+    """
+    Streams read results to a historian over one persistent TCP connection
+
+    Records are queued and sent by a background thread in batches.  Each
+    batch is a 4 byte big endian length followed by zlib compressed JSON
+    Lines, one line per read response.  When the queue is full, write()
+    either drops the oldest record or blocks until the sender catches up,
+    depending on policy.  Blocking gives up after block_timeout seconds, or
+    when the job writing is cancelled, and drops the new record instead, so
+    a historian that went away never stalls a read or poll for good.
+    """
+
+    policies = ["block", "drop"]
+
+    def __init__(
+        self,
+        host,
+        port,
+        policy="drop",
+        queue_size=10000,
+        batch_size=500,
+        interval=1,
+        block_timeout=5,
+    ):
+        assert policy in self.policies, "policy must be block or drop"
+        assert queue_size > 0 and batch_size > 0, "sizes must be at least 1"
+        self.host = host
+        self.port = port
+        self.policy = policy
+        self.queue_size = queue_size
+        self.batch_size = batch_size
+        self.interval = interval  # max seconds to wait for a batch to fill
+        self.block_timeout = block_timeout  # max seconds write() waits for room
+        self.stalled = False  # a write timed out, drop until the sender makes room
+        self.queue = deque()
+        self.lock = threading.Condition()
+        self.socket = None
+        self.closed = False
+        self.started = monotonic()
+        self.received = 0  # records written by the read and poll paths
+        self.sent = 0  # records delivered to the historian
+        self.batches = 0
+        self.bytes = 0  # compressed bytes delivered
+        self.dropped = 0
+        self.max_depth = 0
+        self.error = None
+        self._connect()
+        self.thread = threading.Thread(target=self._run, daemon=True)
+        self.thread.start()
+
+    def __repr__(self):
+        return "{}:{} ({} queued, {} sent, {} dropped)".format(
+            self.host, self.port, len(self.queue), self.sent, self.dropped
+        )
+
+    @property
+    def metrics(self):
+        """Throughput and queue depth since the historian was opened"""
+        elapsed = monotonic() - self.started
+        return {
+            "Historian": "{}:{}".format(self.host, self.port),
+            "Policy": self.policy,
+            "Connected": self.socket is not None,
+            "Records received": self.received,
+            "Records sent": self.sent,
+            "Records dropped": self.dropped,
+            "Batches sent": self.batches,
+            "Compressed bytes": self.bytes,
+            "Records/s": round(self.sent / elapsed, 1) if elapsed else 0,
+            "Queue depth": len(self.queue),
+            "Max queue depth": self.max_depth,
+            "Queue size": self.queue_size,
+            "Last error": self.error or "",
+        }
+
+    def write(self, function, start, values):
+        """
+        Queue one read response for the historian
+
+        :PARAM: function: Modbus function code that produced the values
+        :PARAM: start: Address of the first value
+        :PARAM: values: List of int values, one per address
+        """
+        record = {
+            "timestamp": datetime.now().isoformat(),
+            "function": function,
+            "start": start,
+            "values": list(values),
+        }
+        with self.lock:
+            if self.policy == "block":
+                job = jobs.current()
+                deadline = monotonic() + self.block_timeout
+                while len(self.queue) >= self.queue_size and not self.closed:
+                    remaining = deadline - monotonic()
+                    if self.stalled or remaining <= 0 or (job and job.cancelled):
+                        self.stalled = True
+                        self.dropped += 1
+                        return
+                    self.lock.wait(min(remaining, CANCEL_CHECK))
+            if len(self.queue) >= self.queue_size:
+                self.queue.popleft()
+                self.dropped += 1
+            self.queue.append(record)
+            self.received += 1
+            self.max_depth = max(self.max_depth, len(self.queue))
+            self.lock.notify_all()
+
+    def close(self, timeout=5):
+        """
+        Send what is still queued, then close the connection
+
+        :PARAM: timeout: Max seconds to wait for the queue to drain
+        """
+        with self.lock:
+            self.closed = True
+            self.lock.notify_all()
+        self.thread.join(timeout)
+        if self.socket:
+            self.socket.close()
+            self.socket = None
+
+    def _connect(self):
+        try:
+            self.socket = socket.create_connection((self.host, self.port), timeout=3)
+            self.socket.setsockopt(socket.SOL_SOCKET, socket.SO_KEEPALIVE, 1)
+            self.error = None
+        except OSError as error:
+            self.socket = None
+            self.error = str(error)
+
+    def _next_batch(self):
+        """Wait for a full batch, for interval to pass, or for close"""
+        with self.lock:
+            deadline = None
+            while len(self.queue) < self.batch_size and not self.closed:
+                if not self.queue:
+                    self.lock.wait()
+                    continue
+                if deadline is None:
+                    deadline = monotonic() + self.interval
+                remaining = deadline - monotonic()
+                if remaining <= 0:
+                    break
+                self.lock.wait(remaining)
+            count = min(self.batch_size, len(self.queue))
+            batch = [self.queue.popleft() for _ in range(count)]
+            self.stalled = False
+            self.lock.notify_all()
+            return batch
+
+    def _requeue(self, batch):
+        """Put an unsent batch back in front, dropping the oldest if policy is drop"""
+        with self.lock:
+            room = max(self.queue_size - len(self.queue), 0)
+            if self.policy == "drop" and room < len(batch):
+                self.dropped += len(batch) - room
+                batch = batch[len(batch) - room :]
+            self.queue.extendleft(reversed(batch))
+
+    def _run(self):
+        """Sender thread, reconnecting with backoff whenever a send fails"""
+        backoff = 0.5
+        while True:
+            batch = self._next_batch()
+            if not batch:
+                return  # closed and drained
+            lines = "\n".join(json.dumps(record) for record in batch) + "\n"
+            payload = zlib.compress(lines.encode())
+            try:
+                if self.socket is None:
+                    self._connect()
+                    assert self.socket, self.error
+                self.socket.sendall(struct.pack(">I", len(payload)) + payload)
+            except (OSError, AssertionError) as error:
+                self.error = str(error)
+                if self.socket:
+                    self.socket.close()
+                self.socket = None
+                self._requeue(batch)
+                if self.closed:
+                    return
+                sleep(backoff)
+                backoff = min(backoff * 2, 30)
+                continue
+            backoff = 0.5
+            self.sent += len(batch)
+            self.batches += 1
+            self.bytes += len(payload)
@@ -0,0 +1,216 @@
+"""
+Control Things Modbus, aka ctmodbus.py
+
+# Copyright (C) 2019  Justin Searle
+#
+# This program is free software: you can redistribute it and/or modify it under
+# the terms of the GNU General Public License as published by the Free Software
+# Foundation, either version 3 of the License, or any later version.
+#
+# This program is distributed in the hope that it will be useful, but WITHOUT
+# ANY WARRANTY; without even the implied warranty of MERCHANTABILITY or FITNESS
+# FOR A PARTICULAR PURPOSE.  See the GNU General Public License for more
+# details at <http://www.gnu.org/licenses/>.
+"""
+
+import contextvars
+import threading
+import time
+import traceback
+from datetime import timedelta
+from time import monotonic
+
+_local = threading.local()
+
+
+def current():
+    """The job running on this thread, or None in the foreground"""
+    return getattr(_local, "job", None)
+
+
+def sleep(seconds):
+    """
+    Sleep, waking early if the job on this thread is cancelled
+
+    Returns True if the job was cancelled.
+
+    :PARAM: seconds: Time to sleep
+    """
+    job = current()
+    if job:
+        return job.sleep(seconds)
+    time.sleep(seconds)
+    return False
+
+
+class Job(object):
+    """
+    A command running on its own thread, with progress and cancellation
+
+    Code running inside the job finds it with current().  It adds the requests
+    it plans to send with expect(), counts them off with step(), and stops
+    early, keeping what it has so far, once cancelled is set.
+    """
+
+    def __init__(self, id, line, func, on_change=None, on_chunk=None):
+        self.id = id
+        self.line = line  # command line that started the job
+        self.func = func
+        self.on_change = on_change
+        self.on_chunk = on_chunk  # called with each chunk read, to stream it
+        self.total = 0  # requests planned
+        self.done = 0  # requests sent
+        self.fixed = False  # total is final, ignore further expect()
+        self.status = "running"
+        self.output_text = ""
+        self.dialogs = []  # dialogs raised while running, shown when done
+        self.error = None
+        self.started = monotonic()
+        self.finished = None
+        self.context = contextvars.copy_context()  # of the thread starting it
+        self.lock = threading.Lock()
+        self.cancel_event = threading.Event()
+        self.thread = threading.Thread(target=self._run, daemon=True)
+
+    def __repr__(self):
+        return "Job {} {} ({})".format(self.id, self.line, self.progress)
+
+    @property
+    def cancelled(self):
+        return self.cancel_event.is_set()
+
+    @property
+    def running(self):
+        return self.status == "running"
+
+    @property
+    def elapsed(self):
+        return (self.finished or monotonic()) - self.started
+
+    @property
+    def rate(self):
+        """Requests per second since the job started"""
+        elapsed = self.elapsed
+        return self.done / elapsed if elapsed else 0.0
+
+    @property
+    def eta(self):
+        """Estimated seconds left, or None until there is a rate to go by"""
+        if not self.running:
+            return 0.0
+        rate = self.rate
+        if not rate or self.total < self.done:
+            return None
+        return (self.total - self.done) / rate
+
+    @property
+    def progress(self):
+        """Short progress line, like 120/525 req 85.3/s ETA 0:00:05"""
+        text = "{}/{} req {:.1f}/s".format(self.done, self.total, self.rate)
+        if self.running:
+            eta = self.eta
+            text += " ETA {}".format(_duration(eta) if eta is not None else "?")
+        else:
+            text += " {} in {}".format(self.status, _duration(self.elapsed))
+        return text
+
+    def expect(self, requests):
+        """
+        Add requests to the planned total
+
+        :PARAM: requests: Number of requests about to be sent
+        """
+        with self.lock:
+            if not self.fixed:
+                self.total += requests
+
+    def fix_total(self, total):
+        """
+        Set the final planned total, ignoring any later expect()
+
+        :PARAM: total: Number of requests the whole job will send
+        """
+        with self.lock:
+            self.total = total
+            self.fixed = True
+
+    def step(self, requests=1):
+        """
+        Count requests as done
+
+        :PARAM: requests: Number of requests sent or skipped
+        """
+        with self.lock:
+            self.done += requests
+        self._changed()
+
+    def sleep(self, seconds):
+        """Sleep, waking early when cancelled.  Returns True if cancelled"""
+        return self.cancel_event.wait(seconds)
+
+    def cancel(self):
+        """Ask the job to stop after its current request"""
+        self.cancel_event.set()
+
+    def start(self):
+        self.thread.start()
+
+    def _run(self):
+        _local.job = self
+        try:
+            self.output_text = self.func() or ""
+            self.status = "cancelled" if self.cancelled else "done"
+        except AssertionError as error:
+            self.error = str(error)
+            self.status = "failed"
+        except Exception:
+            self.error = traceback.format_exc()
+            self.status = "failed"
+        finally:
+            _local.job = None
+            self.finished = monotonic()
+            self._changed()
+
+    def _changed(self):
+        if self.on_change:
+            self.on_change(self)
+
+
+class Jobs(object):
+    """Every background job started this session, by id"""
+
+    def __init__(self, on_change=None):
+        self.jobs = {}
+        self.on_change = on_change  # called from job threads on progress and end
+        self.on_chunk = None  # called from job threads with each chunk read
+        self.next_id = 1
+
+    def __iter__(self):
+        return iter(self.jobs.values())
+
+    def __getitem__(self, id):
+        assert id in self.jobs, "There is no job {}".format(id)
+        return self.jobs[id]
+
+    @property
+    def running(self):
+        return [job for job in self if job.running]
+
+    def start(self, line, func):
+        """
+        Run func on a new background thread
+
+        :PARAM: line: Command line the job runs, for listing
+        :PARAM: func: Zero argument function returning output text
+        """
+        job = Job(
+            self.next_id, line, func, on_change=self.on_change, on_chunk=self.on_chunk
+        )
+        self.jobs[job.id] = job
+        self.next_id += 1
+        job.start()
+        return job
+
+
+def _duration(seconds):
+    return str(timedelta(seconds=round(seconds)))
@@ -0,0 +1,196 @@
+"""
+Control Things Modbus, aka ctmodbus.py
+
+# Copyright (C) 2019  Justin Searle
+#
+# This program is free software: you can redistribute it and/or modify it under
+# the terms of the GNU General Public License as published by the Free Software
+# Foundation, either version 3 of the License, or any later version.
+#
+# This program is distributed in the hope that it will be useful, but WITHOUT
+# ANY WARRANTY; without even the implied warranty of MERCHANTABILITY or FITNESS
+# FOR A PARTICULAR PURPOSE.  See the GNU General Public License for more
+# details at <http://www.gnu.org/licenses/>.
+"""
+
+import itertools
+import random
+import threading
+from time import monotonic
+
+import numpy as np
+
+from ctmodbus import common, jobs
+from ctmodbus.scan import READS
+
+# outcome of each request
+OK, REFUSED, NO_RESPONSE, DROPPED = range(4)
+OUTCOMES = ["ok", "exception response", "no response", "connection error"]
+MAX_COUNT = {1: 2000, 2: 2000, 3: 125, 4: 125}  # per read, by function code
+RECONNECT_DELAY = 0.1  # seconds
+
+
+def parse_mix(spec):
+    """
+    Parse a request mix like 3:0-99*4,4:0-9,1:0-999
+
+    Each item is function:start[-stop][*weight].  Items are picked at random
+    in proportion to their weight, which defaults to 1.
+
+    :PARAM: spec: Comma separated request mix items
+    """
+    mix = []
+    for item in spec.split(","):
+        item, _, weight = item.partition("*")
+        function, _, addresses = item.partition(":")
+        assert (
+            function.isdigit() and int(function) in READS
+        ), f"{item} must start with a read function code 1-4, like 3:0-99"
+        function = int(function)
+        loops = list(common.Loops(addresses, minimum=0, maximum=65535))
+        assert len(loops) == 1, f"{item} must have one address or range"
+        start, stop, count = loops[0].values()
+        assert (
+            count <= MAX_COUNT[function]
+        ), f"{item} reads more than {MAX_COUNT[function]} addresses"
+        assert weight.isdigit() or not weight, f"{weight} is not a whole number"
+        mix.append((function, start, count, int(weight or 1)))
+    return mix
+
+
+class LoadTest(object):
+    """
+    Drive a request mix at a device over several connections at once
+
+    Each connection has its own worker thread sending one request at a
+    time.  With a target rate, requests are spread evenly over time across
+    all the workers.  Without one, every worker sends as fast as the device
+    answers.  The latency and outcome of every request is kept, so results
+    can be broken down by interval.
+    """
+
+    def __init__(self, clients, mix, rate=0, duration=10, unit=1):
+        self.clients = clients  # one connected pymodbus client per worker
+        self.mix = mix
+        self.rate = rate  # target requests per second, 0 for as fast as possible
+        self.duration = duration
+        self.unit = unit
+        self.samples = []  # per worker lists of (sent at, latency, outcome)
+        self.started = None
+        self.elapsed = 0.0
+        self._next = itertools.count()
+
+    def __repr__(self):
+        return "LoadTest({} connections, {} req/s, {} s)".format(
+            len(self.clients), self.rate or "max", self.duration
+        )
+
+    def run(self):
+        """Run the test, returning once every worker has finished"""
+        job = jobs.current()
+        if job and self.rate:
+            job.expect(int(self.rate * self.duration))
+        self.samples = [[] for _ in self.clients]
+        self.started = monotonic()
+        workers = [
+            threading.Thread(target=self._work, args=(i, client, job), daemon=True)
+            for i, client in enumerate(self.clients)
+        ]
+        for worker in workers:
+            worker.start()
+        for worker in workers:
+            worker.join()
+        self.elapsed = monotonic() - self.started
+
+    def _work(self, i, client, job):
+        picker = random.Random(i)
+        items = [(function, start, count) for function, start, count, _ in self.mix]
+        weights = [weight for *_, weight in self.mix]
+        reads = {function: getattr(client, READS[function]) for function in READS}
+        samples = self.samples[i]
+        cancel = job.cancel_event if job else threading.Event()
+        end = self.started + self.duration
+        while not cancel.is_set() and monotonic() < end:
+            if self.rate:
+                # a device that can not keep up makes workers fall behind, so
+                # late requests go out at once and the rate measured drops
+                send_at = self.started + next(self._next) / self.rate
+                if send_at >= end or cancel.wait(max(0, send_at - monotonic())):
+                    break
+            function, start, count = picker.choices(items, weights)[0]
+            sent = monotonic()
+            try:
+                response = reads[function](start, count, unit=self.unit)
+                if hasattr(response, "exception_code"):
+                    outcome = REFUSED
+                elif hasattr(response, "bits") or hasattr(response, "registers"):
+                    outcome = OK
+                else:
+                    outcome = NO_RESPONSE
+            except Exception:
+                outcome = DROPPED
+            samples.append((sent - self.started, monotonic() - sent, outcome))
+            if job:
+                job.step()
+            if outcome == DROPPED:
+                # pymodbus reconnects on the next request, so give it a moment
+                client.close()
+                cancel.wait(RECONNECT_DELAY)
+
+    def _arrays(self):
+        samples = [sample for worker in self.samples for sample in worker]
+        data = np.array(samples, dtype=float).reshape(-1, 3)
+        return data[:, 0], data[:, 1], data[:, 2].astype(int)
+
+    def intervals(self, seconds=1):
+        """
+        One row per interval: start, requests, req/s, latency percentiles, errors
+
+        Latencies are in milliseconds over the requests the device answered.
+
+        :PARAM: seconds: Length of each interval
+        """
+        sent, latency, outcome = self._arrays()
+        rows = []
+        for i in range(int(sent.max(initial=0) // seconds) + 1):
+            first = i * seconds
+            mask = (sent >= first) & (sent < first + seconds)
+            rows.append(
+                [f"{first:g}", int(mask.sum()), f"{mask.sum() / seconds:.1f}"]
+                + _latencies(latency[mask & (outcome <= REFUSED)])
+                + [_percent((outcome[mask] != OK).sum(), mask.sum())]
+            )
+        return rows
+
+    def summary(self):
+        """Throughput, latency percentiles and error counts over the whole test"""
+        sent, latency, outcome = self._arrays()
+        answered = latency[outcome <= REFUSED]
+        p50, p90, p99, worst = _latencies(answered)
+        summary = {
+            "Connections": len(self.clients),
+            "Target req/s": self.rate or "max",
+            "Seconds": round(self.elapsed, 2),
+            "Requests": len(sent),
+            "Req/s": round(len(sent) / self.elapsed, 1) if self.elapsed else 0,
+            "Latency p50 ms": p50,
+            "Latency p90 ms": p90,
+            "Latency p99 ms": p99,
+            "Latency max ms": worst,
+        }
+        for code, name in enumerate(OUTCOMES[1:], 1):
+            count = int((outcome == code).sum())
+            summary[name.capitalize()] = f"{count} ({_percent(count, len(sent))})"
+        return summary
+
+
+def _latencies(latency):
+    """p50, p90, p99 and max of latency seconds, as millisecond strings"""
+    if not len(latency):
+        return ["", "", "", ""]
+    values = np.percentile(latency, [50, 90, 99, 100]) * 1000
+    return ["{:.1f}".format(value) for value in values]
+
+
+def _percent(count, total):
+    return "{:.1f}%".format(100 * count / total) if total else ""
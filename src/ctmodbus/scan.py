@@ -0,0 +1,208 @@
+"""
+Control Things Modbus, aka ctmodbus.py
+
+# Copyright (C) 2019  Justin Searle
+#
+# This program is free software: you can redistribute it and/or modify it under
+# the terms of the GNU General Public License as published by the Free Software
+# Foundation, either version 3 of the License, or any later version.
+#
+# This program is distributed in the hope that it will be useful, but WITHOUT
+# ANY WARRANTY; without even the implied warranty of MERCHANTABILITY or FITNESS
+# FOR A PARTICULAR PURPOSE.  See the GNU General Public License for more
+# details at <http://www.gnu.org/licenses/>.
+"""
+
+from concurrent.futures import ThreadPoolExecutor
+from time import monotonic
+
+from pymodbus.client.sync import ModbusSerialClient, ModbusTcpClient
+
+from ctmodbus import common, tls
+
+# session method for each read function code
+READS = {
+    1: "read_coils",
+    2: "read_discrete_inputs",
+    3: "read_holding_registers",
+    4: "read_input_registers",
+}
+PROBE_TIMEOUT = 0.5  # seconds for a local service to answer a probe
+# listen on every address, probed on loopback
+LOOPBACK = {"0.0.0.0": "127.0.0.1", "::": "::1"}
+
+
+class PortScan(object):
+    """Results and timing of reading one serial port"""
+
+    def __init__(self, device):
+        self.device = device
+        self.results = {}  # {unit: {address: value}}
+        self.requests = 0
+        self.errors = 0  # requests that got no reply
+        self.refused = 0  # requests answered with a Modbus exception
+        self.elapsed = 0.0
+        self.error = None
+
+    def __repr__(self):
+        return "{} ({} units, {} requests)".format(
+            self.device, len(self.results), self.requests
+        )
+
+
+def scan_port(device, method, function, ranges, units, timeout, job=None, saved=None):
+    """
+    Read ranges from every unit on one serial port with its own session
+
+    A unit that does not answer its first request is skipped, so sweeping
+    unit ids only costs one timeout per missing unit.  An exception reply
+    still shows the unit is there.  Chunks already in the checkpoint are not
+    read again.  A cancel, an error, or a chunk missed from a unit that did
+    answer leaves the checkpoint in place for resume, while skipped units
+    are simply probed again and refused chunks are not worth resuming.
+
+    :PARAM: device: Serial device path or COM port
+    :PARAM: method: rtu or ascii
+    :PARAM: function: Modbus read function code 1-4
+    :PARAM: ranges: List of (start, stop, count) to read from each unit
+    :PARAM: units: List of unit ids to read
+    :PARAM: timeout: Seconds to wait for each response
+    :PARAM: job: Optional background job to report progress to and stop with
+    :PARAM: saved: Optional checkpoint to restore and record chunks with
+    """
+    scan = PortScan(device)
+    started = monotonic()
+    client = ModbusSerialClient(method=method, port=device, timeout=timeout)
+    try:
+        assert client.connect(), "Could not connect to {}".format(device)
+        read = getattr(client, READS[function])
+        attr = "bits" if function in (1, 2) else "registers"
+        for unit in units:
+            for i, (start, stop, count) in enumerate(ranges):
+                if job and job.cancelled:
+                    if saved:
+                        saved.interrupted = True
+                    return scan
+                values = (
+                    saved.get(function, start, count, device, unit) if saved else None
+                )
+                if values is not None:
+                    if job:
+                        job.step()
+                else:
+                    scan.requests += 1
+                    response = read(start, count, unit=unit)
+                    if job:
+                        job.step()
+                    if hasattr(response, "exception_code"):
+                        scan.refused += 1
+                        scan.results.setdefault(unit, {})  # refused, but there
+                        continue  # asking again gets the same answer
+                    if not hasattr(response, attr):
+                        scan.errors += 1
+                        if unit not in scan.results:
+                            if job:
+                                job.step(len(ranges) - i - 1)  # skipped
+                            break
+                        if saved:
+                            saved.interrupted = True
+                        continue
+                    values = [int(value) for value in getattr(response, attr)[:count]]
+                    if saved:
+                        saved.put(function, start, values, device, unit)
+                scan.results.setdefault(unit, {}).update(
+                    zip(range(start, stop), values)
+                )
+    except Exception as error:
+        scan.error = str(error)
+        if saved:
+            saved.interrupted = True
+    finally:
+        client.close()
+        scan.elapsed = monotonic() - started
+    return scan
+
+
+def scan_ports(
+    devices, method, function, csr, units, max, timeout, job=None, saved=None
+):
+    """
+    Scan several serial ports at once, one worker thread per port
+
+    :PARAM: devices: List of serial device paths or COM ports
+    :PARAM: method: rtu or ascii
+    :PARAM: function: Modbus read function code 1-4
+    :PARAM: csr: Comma separated ranges to read
+    :PARAM: units: Comma separated ranges of unit ids to read
+    :PARAM: max: Max addresses to read per request
+    :PARAM: timeout: Seconds to wait for each response
+    :PARAM: job: Optional background job to report progress to and stop with
+    :PARAM: saved: Optional checkpoint to restore and record chunks with
+    """
+    ranges = [tuple(loop) for loop in common.csr_to_ranges(csr, max)]
+    unit_ids = list(common.Loops(units, minimum=0, maximum=247).enum())
+    if job:
+        job.expect(len(devices) * len(unit_ids) * len(ranges))
+    with ThreadPoolExecutor(max_workers=len(devices)) as pool:
+        futures = [
+            pool.submit(
+                scan_port,
+                device,
+                method,
+                function,
+                ranges,
+                unit_ids,
+                timeout,
+                job,
+                saved,
+            )
+            for device in devices
+        ]
+        return [future.result() for future in futures]
+
+
+def probe(host, port, timeout=PROBE_TIMEOUT):
+    """
+    Send one quick read to a TCP service, returning whether Modbus answered
+
+    Any Modbus reply, even an exception response, shows a Modbus server.
+    Port 802 is probed with TLS, as Modbus/TCP Security.
+
+    :PARAM: host: IP or hostname of the service
+    :PARAM: port: TCP port of the service
+    :PARAM: timeout: Seconds to wait to connect and for the reply
+    """
+    host = LOOPBACK.get(host, host)
+    if port == 802:
+        client = tls.SessionTlsClient(host, port, timeout=timeout)
+    else:
+        client = ModbusTcpClient(host, port, timeout=timeout)
+    try:
+        if not client.connect():
+            return "no, can not connect"
+        response = client.read_holding_registers(0, 1, unit=1)
+    except Exception:
+        return "no"
+    finally:
+        client.close()
+    if hasattr(response, "exception_code"):
+        return "yes, exception {}".format(response.exception_code)
+    if hasattr(response, "registers"):
+        return "yes"
+    return "no answer"
+
+
+def probe_all(listeners, timeout=PROBE_TIMEOUT):
+    """
+    Probe TCP services all at once, one worker thread per service
+
+    :PARAM: listeners: List of (host, port) to probe
+    :PARAM: timeout: Seconds to wait to connect and for each reply
+    """
+    if not listeners:
+        return {}
+    with ThreadPoolExecutor(max_workers=min(len(listeners), 32)) as pool:
+        futures = [pool.submit(probe, host, port, timeout) for host, port in listeners]
+        return {
+            listener: future.result() for listener, future in zip(listeners, futures)
+        }
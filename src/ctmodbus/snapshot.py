@@ -0,0 +1,204 @@
+"""
+Control Things Modbus, aka ctmodbus.py
+
+# Copyright (C) 2019  Justin Searle
+#
+# This program is free software: you can redistribute it and/or modify it under
+# the terms of the GNU General Public License as published by the Free Software
+# Foundation, either version 3 of the License, or any later version.
+#
+# This program is distributed in the hope that it will be useful, but WITHOUT
+# ANY WARRANTY; without even the implied warranty of MERCHANTABILITY or FITNESS
+# FOR A PARTICULAR PURPOSE.  See the GNU General Public License for more
+# details at <http://www.gnu.org/licenses/>.
+"""
+
+from pathlib import Path
+
+import numpy as np
+
+from ctmodbus.datatypes import contiguous_runs
+
+# table names indexed by read function code - 1
+TABLES = ["coils", "discreteInputs", "holdingRegisters", "inputRegisters"]
+ADDRESSES = 65536
+
+
+class Snapshot(object):
+    """Packed image of every coil, input and register value read from a device"""
+
+    def __init__(self, source=None):
+        self.values = np.zeros((len(TABLES), ADDRESSES), dtype=np.uint16)
+        self.valid = np.zeros((len(TABLES), ADDRESSES), dtype=bool)
+        self.source = source  # device and unit the values were read from
+
+    def __repr__(self):
+        counts = self.valid.sum(axis=1)
+        text = ", ".join(
+            "{} {}".format(table, count) for table, count in zip(TABLES, counts)
+        )
+        return "{} from {}".format(text, self.source) if self.source else text
+
+    def __len__(self):
+        return int(self.valid.sum())
+
+    def update(self, function, start, values):
+        """
+        Store values read with function starting at address start
+
+        :PARAM: function: Modbus read function code 1-4
+        :PARAM: start: Address of the first value
+        :PARAM: values: List of int values, one per address
+        """
+        stop = start + len(values)
+        self.values[function - 1, start:stop] = values
+        self.valid[function - 1, start:stop] = True
+
+    def update_results(self, function, results):
+        """
+        Store a results dict as built by the read commands
+
+        :PARAM: function: Modbus read function code 1-4
+        :PARAM: results: Dict of {address: value}
+        """
+        addresses = np.fromiter(results.keys(), dtype=np.int64, count=len(results))
+        values = np.fromiter(results.values(), dtype=np.uint16, count=len(results))
+        self.values[function - 1, addresses] = values
+        self.valid[function - 1, addresses] = True
+
+    def ranges(self, function):
+        """
+        Yield (start, stop) of each contiguous run of valid addresses
+
+        :PARAM: function: Modbus read function code 1-4
+        """
+        addresses = np.flatnonzero(self.valid[function - 1])
+        for first, stop in contiguous_runs(addresses):
+            yield int(addresses[first]), int(addresses[stop - 1]) + 1
+
+    def save(self, filename):
+        """Save as a compressed .npz file"""
+        path = Path(filename).expanduser()
+        with open(path, "wb") as f:
+            np.savez_compressed(
+                f, values=self.values, valid=self.valid, source=self.source or ""
+            )
+        return str(path)
+
+    @classmethod
+    def load(cls, filename):
+        """Load a snapshot saved with save()"""
+        path = Path(filename).expanduser()
+        assert path.is_file(), "{} is not a snapshot file".format(path)
+        snapshot = cls()
+        with np.load(path) as data:
+            assert (
+                data["values"].shape == snapshot.values.shape
+            ), "{} is not a snapshot file".format(path)
+            snapshot.values[:] = data["values"]
+            snapshot.valid[:] = data["valid"]
+            if "source" in data.files:
+                snapshot.source = str(data["source"]) or None
+        return snapshot
+
+
+STATUSES = ["changed", "removed", "added"]
+
+
+class Differences(object):
+    """
+    Runs of changed addresses between two snapshots, kept as numpy columns
+
+    Rows are only formatted when asked for, so a diff with many thousands
+    of runs costs nothing beyond the few rows that are shown.
+    """
+
+    def __init__(self, old, new, tables, starts, stops, statuses):
+        self.old = old
+        self.new = new
+        self.tables = tables  # table index of each run
+        self.starts = starts  # first address of each run
+        self.stops = stops  # address after the last of each run
+        self.statuses = statuses  # index into STATUSES of each run
+
+    def __len__(self):
+        return len(self.tables)
+
+    def rows(self, limit=None):
+        """
+        Rows of [table, "start-stop", status, old values, new values]
+
+        :PARAM: limit: Optional most rows to format, from the lowest address
+        """
+        rows = []
+        count = len(self) if limit is None else min(limit, len(self))
+        runs = zip(
+            self.tables[:count].tolist(),
+            self.starts[:count].tolist(),
+            self.stops[:count].tolist(),
+            self.statuses[:count].tolist(),
+        )
+        for table, start, stop, status in runs:
+            status = STATUSES[status]
+            rows.append(
+                [
+                    TABLES[table],
+                    "{}-{}".format(start, stop - 1) if stop - start > 1 else str(start),
+                    status,
+                    _summarize(self.old, table, start, stop, status != "added"),
+                    _summarize(self.new, table, start, stop, status != "removed"),
+                ]
+            )
+        return rows
+
+
+def diff(old, new):
+    """
+    Compare two snapshots, returning the runs of changed addresses
+
+    Each run's status is "changed", "removed" (only in old) or "added" (only
+    in new).  Runs are found with array operations over the whole image and
+    sorted by table and address.
+
+    :PARAM: old: Snapshot to compare from
+    :PARAM: new: Snapshot to compare to
+    """
+    both = old.valid & new.valid
+    masks = [
+        both & (old.values != new.values),
+        old.valid & ~new.valid,
+        new.valid & ~old.valid,
+    ]
+    columns = []
+    for status, mask in enumerate(masks):
+        tables, starts, stops = _runs(mask)
+        columns.append((tables, starts, stops, np.full(len(tables), status)))
+    tables, starts, stops, statuses = (np.concatenate(c) for c in zip(*columns))
+    order = np.lexsort((starts, tables))
+    return Differences(
+        old, new, tables[order], starts[order], stops[order], statuses[order]
+    )
+
+
+def _runs(mask):
+    """(tables, starts, stops) of each run of True in a tables by addresses mask"""
+    tables, addresses = np.nonzero(mask)
+    if not len(addresses):
+        return tables, addresses, addresses
+    # offset each table so runs never continue from one table into the next
+    flat = tables * (ADDRESSES + 1) + addresses
+    breaks = np.flatnonzero(np.diff(flat) != 1) + 1
+    firsts = np.concatenate(([0], breaks))
+    lasts = np.concatenate((breaks, [len(flat)])) - 1
+    return tables[firsts], addresses[firsts], addresses[lasts] + 1
+
+
+def _summarize(snapshot, table, start, stop, present, limit=4):
+    """Short hex listing of a run of values"""
+    if not present:
+        return ""
+    values = snapshot.values[table, start:stop]
+    text = " ".join("{:04x}".format(value) for value in values[:limit].tolist())
+    if len(values) > limit:
+        text += " ..."
+    return text
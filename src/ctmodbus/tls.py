@@ -0,0 +1,163 @@
+"""
+Control Things Modbus, aka ctmodbus.py
+
+# Copyright (C) 2019  Justin Searle
+#
+# This program is free software: you can redistribute it and/or modify it under
+# the terms of the GNU General Public License as published by the Free Software
+# Foundation, either version 3 of the License, or any later version.
+#
+# This program is distributed in the hope that it will be useful, but WITHOUT
+# ANY WARRANTY; without even the implied warranty of MERCHANTABILITY or FITNESS
+# FOR A PARTICULAR PURPOSE.  See the GNU General Public License for more
+# details at <http://www.gnu.org/licenses/>.
+"""
+
+import socket
+import ssl
+from pathlib import Path
+from time import monotonic
+
+from pymodbus.client.sync import ModbusTlsClient
+
+# A TLS session can only be resumed with the SSLContext that created it, so
+# contexts are shared by every client using the same certificate files.
+_contexts = {}  # {(cafile, certfile, keyfile): SSLContext}
+_sessions = {}  # {(host, port, cafile, certfile, keyfile): SSLSession}
+
+
+def tls_context(cafile=None, certfile=None, keyfile=None):
+    """
+    Shared client SSLContext for a set of certificate files
+
+    Without cafile the device certificate is not verified, as most devices
+    under test use self-signed certificates.
+
+    :PARAM: cafile: CA certificate file to verify the device with, or None
+    :PARAM: certfile: Client certificate file, or None
+    :PARAM: keyfile: Client private key file, or None if it is in certfile
+    """
+    files = tuple(
+        str(Path(f).expanduser()) if f else None for f in (cafile, certfile, keyfile)
+    )
+    for f in files:
+        assert f is None or Path(f).is_file(), f"{f} is not a file"
+    assert files[1] or not files[2], "keyfile needs a certfile"
+    if files not in _contexts:
+        cafile, certfile, keyfile = files
+        if cafile:
+            context = ssl.create_default_context(cafile=cafile)
+        else:
+            context = ssl.SSLContext(ssl.PROTOCOL_TLS_CLIENT)
+            context.check_hostname = False
+            context.verify_mode = ssl.CERT_NONE
+        # Modbus/TCP Security requires TLS 1.2 or later
+        context.minimum_version = ssl.TLSVersion.TLSv1_2
+        if certfile:
+            context.load_cert_chain(certfile, keyfile)
+        _contexts[files] = context
+    return _contexts[files], files
+
+
+class SessionTlsClient(ModbusTlsClient):
+    """
+    Modbus/TCP Security client that resumes TLS sessions and keeps alive
+
+    Every new connection to a host and port offers the TLS session of the
+    last one, so reconnects, including the ones pymodbus makes after a
+    dropped connection, skip the full handshake.  TCP keepalive stops idle
+    connections from being dropped by firewalls in between.
+    """
+
+    def __init__(
+        self,
+        host,
+        port=802,
+        cafile=None,
+        certfile=None,
+        keyfile=None,
+        keepalive=60,
+        **kwargs,
+    ):
+        sslctx, files = tls_context(cafile, certfile, keyfile)
+        ModbusTlsClient.__init__(self, host, port, sslctx=sslctx, **kwargs)
+        self.files = files  # (cafile, certfile, keyfile)
+        self.session_key = (host, port) + files
+        self.keepalive = keepalive  # idle seconds before the first probe
+        self.version = None
+        self.resumed = False
+        self.handshake_time = None  # seconds, of the last handshake
+        self.full_time = None  # seconds, of the last full handshake
+        self.handshakes = 0
+        self.resumptions = 0
+        self.error = None
+
+    def __str__(self):
+        text = "ModbusTlsClient({}:{})".format(self.host, self.port)
+        if self.handshake_time is None:
+            return text
+        text += " {} {} handshake {:.1f} ms".format(
+            self.version,
+            "resumed" if self.resumed else "full",
+            self.handshake_time * 1000,
+        )
+        if self.resumed and self.full_time is not None:
+            text += " (full {:.1f} ms)".format(self.full_time * 1000)
+        return text + ", {}/{} resumed".format(self.resumptions, self.handshakes)
+
+    def connect(self):
+        """Connect, resuming the last TLS session with this host if there is one"""
+        if self.socket:
+            return True
+        sock = None
+        try:
+            sock = socket.create_connection(
+                (self.host, self.port), self.timeout, self.source_address
+            )
+            self._keep_alive(sock)
+            sock = self.sslctx.wrap_socket(
+                sock,
+                server_hostname=self.host,
+                session=_sessions.get(self.session_key),
+                do_handshake_on_connect=False,
+            )
+            started = monotonic()
+            sock.do_handshake()
+            self.handshake_time = monotonic() - started
+        except OSError as error:
+            self.error = str(error)
+            if sock:
+                sock.close()
+            return False
+        self.socket = sock
+        self.error = None
+        self.version = sock.version()
+        self.resumed = sock.session_reused
+        self.handshakes += 1
+        if self.resumed:
+            self.resumptions += 1
+        else:
+            self.full_time = self.handshake_time
+        self._save_session()
+        return True
+
+    def close(self):
+        """Close the connection, keeping its TLS session for the next connect"""
+        if self.socket:
+            self._save_session()
+            self.socket.close()
+        self.socket = None
+
+    def _save_session(self):
+        # TLS 1.3 tickets only arrive after the handshake, so this is called
+        # again on close to keep the newest one
+        session = self.socket.session
+        if session is not None:
+            _sessions[self.session_key] = session
+
+    def _keep_alive(self, sock):
+        sock.setsockopt(socket.SOL_SOCKET, socket.SO_KEEPALIVE, 1)
+        if hasattr(socket, "TCP_KEEPIDLE"):  # Linux, not macOS or Windows
+            sock.setsockopt(socket.IPPROTO_TCP, socket.TCP_KEEPIDLE, self.keepalive)
+            sock.setsockopt(socket.IPPROTO_TCP, socket.TCP_KEEPINTVL, 10)
+            sock.setsockopt(socket.IPPROTO_TCP, socket.TCP_KEEPCNT, 3)
@@ -0,0 +1,196 @@
+"""
+Control Things Modbus, aka ctmodbus.py
+
+# Copyright (C) 2019  Justin Searle
+#
+# This program is free software: you can redistribute it and/or modify it under
+# the terms of the GNU General Public License as published by the Free Software
+# Foundation, either version 3 of the License, or any later version.
+#
+# This program is distributed in the hope that it will be useful, but WITHOUT
+# ANY WARRANTY; without even the implied warranty of MERCHANTABILITY or FITNESS
+# FOR A PARTICULAR PURPOSE.  See the GNU General Public License for more
+# details at <http://www.gnu.org/licenses/>.
+"""
+
+import socket
+import struct
+import threading
+from collections import deque
+from time import monotonic
+
+from pymodbus.bit_read_message import ReadCoilsRequest, ReadDiscreteInputsRequest
+from pymodbus.client.sync import ModbusUdpClient
+from pymodbus.exceptions import ModbusIOException
+from pymodbus.register_read_message import (
+    ReadHoldingRegistersRequest,
+    ReadInputRegistersRequest,
+)
+
+# request class for each session read method
+REQUESTS = {
+    "read_coils": ReadCoilsRequest,
+    "read_discrete_inputs": ReadDiscreteInputsRequest,
+    "read_holding_registers": ReadHoldingRegistersRequest,
+    "read_input_registers": ReadInputRegistersRequest,
+}
+MBAP_HEADER = ">HHHB"  # transaction id, protocol id, length, unit id
+MIN_RTO = 0.02  # seconds
+
+
+class WindowedUdpClient(ModbusUdpClient):
+    """
+    Modbus UDP client that keeps a window of requests in flight
+
+    Replies are matched to requests by transaction id, so they may arrive in
+    any order.  Only requests whose reply has not arrived within the
+    retransmission timeout are resent.  The timeout follows the measured
+    round trip time, capped by timeout.
+    """
+
+    def __init__(self, host, port, window=16, retries=3, **kwargs):
+        ModbusUdpClient.__init__(self, host, port, **kwargs)
+        self.window = window
+        self.retries = retries
+        self.srtt = None  # smoothed round trip time
+        self.rttvar = None  # round trip time variation
+        self.backoff = 1
+        self.sent = 0  # datagrams sent, including resends
+        self.resent = 0
+        self.answered = 0
+        self.lost = 0  # requests given up on after all retries
+        self.lock = threading.Lock()  # one pipeline owns the socket at a time
+
+    def __str__(self):
+        return "WindowedUdpClient({}:{}) loss {:.1f}%".format(
+            self.host, self.port, self.loss_rate * 100
+        )
+
+    @property
+    def loss_rate(self):
+        """Fraction of sent datagrams that never got a reply"""
+        return (self.sent - self.answered) / self.sent if self.sent else 0.0
+
+    @property
+    def rto(self):
+        """Retransmission timeout in seconds"""
+        cap = self.timeout or 3
+        if self.srtt is None:
+            rto = 1.0
+        else:
+            rto = max(MIN_RTO, self.srtt + 4 * self.rttvar)
+        return min(cap, rto * self.backoff)
+
+    def close(self):
+        if self.socket:
+            self.socket.close()
+        self.socket = None
+
+    def execute(self, request=None):
+        return next(self.execute_many([request]))
+
+    def read_many(self, read, ranges, **kwargs):
+        """
+        Pipeline one read request per (start, count) range
+
+        :PARAM: read: Session read method, like self.read_coils
+        :PARAM: ranges: List of (start, count) to read
+        """
+        request = REQUESTS[read.__name__]
+        return self.execute_many(
+            [request(start, count, **kwargs) for start, count in ranges]
+        )
+
+    def execute_many(self, requests):
+        """
+        Generator yielding the response to each request, in request order
+
+        A request that is still unanswered after all retries yields a
+        ModbusIOException, as pymodbus returns for a request without reply.
+
+        :PARAM: requests: List of pymodbus request objects
+        """
+        assert self.connect(), "Could not open udp socket"
+        assert self.lock.acquire(blocking=False), "Session is busy with another read"
+        try:
+            yield from self._execute_many(requests)
+        finally:
+            self.lock.release()
+
+    def _execute_many(self, requests):
+        responses = {}
+        pending = {}  # transaction id: [index, sent at, tries]
+        queue = deque(range(len(requests)))
+        next_index = 0
+        while next_index < len(requests):
+            while queue and len(pending) < self.window:
+                index = queue.popleft()
+                request = requests[index]
+                request.transaction_id = self.transaction.getNextTID()
+                pending[request.transaction_id] = [index, 0, 0]
+                self._send_request(request, pending)
+            self._receive(requests, responses, pending)
+            while next_index in responses:
+                yield responses.pop(next_index)
+                next_index += 1
+
+    def _send_request(self, request, pending):
+        entry = pending[request.transaction_id]
+        entry[1] = monotonic()
+        entry[2] += 1
+        self.socket.sendto(self.framer.buildPacket(request), (self.host, self.port))
+        self.sent += 1
+
+    def _receive(self, requests, responses, pending):
+        """Wait for one reply or for the oldest request to time out"""
+        oldest = min(sent for _, sent, _ in pending.values())
+        wait = oldest + self.rto - monotonic()
+        data = None
+        if wait > 0:
+            self.socket.settimeout(wait)
+            try:
+                data = self.socket.recvfrom(1024)[0]
+            except (socket.timeout, ConnectionRefusedError):
+                pass
+        now = monotonic()
+        if data and len(data) > 8:
+            tid, _, length, unit = struct.unpack(MBAP_HEADER, data[:7])
+            entry = pending.get(tid)
+            response = self.framer.decoder.decode(data[7 : 6 + length])
+            if entry and response:
+                index, sent, tries = pending.pop(tid)
+                if response.function_code & 0x7F == requests[index].function_code:
+                    response.transaction_id, response.unit_id = tid, unit
+                    responses[index] = response
+                    self.answered += 1
+                    self.backoff = 1
+                    if tries == 1:  # Karn: only sample unambiguous round trips
+                        self._sample_rtt(now - sent)
+                else:
+                    pending[tid] = [index, sent, tries]
+        # resend only the requests whose timeout expired
+        rto = self.rto
+        expired = [tid for tid, (_, sent, _) in pending.items() if now - sent >= rto]
+        if expired and data is None:
+            # nothing is getting through, so back off instead of flooding
+            self.backoff = min(self.backoff * 2, 64)
+        for tid in expired:
+            index, _, tries = pending[tid]
+            if tries > self.retries:
+                del pending[tid]
+                responses[index] = ModbusIOException(
+                    f"No response received after {self.retries} retries",
+                    requests[index].function_code,
+                )
+                self.lost += 1
+            else:
+                self.resent += 1
+                self._send_request(requests[index], pending)
+
+    def _sample_rtt(self, rtt):
+        """Update the round trip estimate as in RFC 6298"""
+        if self.srtt is None:
+            self.srtt, self.rttvar = rtt, rtt / 2
+        else:
+            self.rttvar = 0.75 * self.rttvar + 0.25 * abs(self.srtt - rtt)
+            self.srtt = 0.875 * self.srtt + 0.125 * rtt
@@ -1,4 +1,5 @@
 import logging
+import ssl
 
 from pymodbus.datastore import (
     ModbusSequentialDataBlock,
@@ -38,11 +39,14 @@ def run_server():
     identity.ModelName = "Pymodbus Server"
     identity.MajorMinorRevision = version.short()
 
+    # pymodbus builds a client side context from certfile and keyfile, which
+    # newer Pythons refuse to use for a server, so pass a server one instead
+    sslctx = ssl.SSLContext(ssl.PROTOCOL_TLS_SERVER)
+    sslctx.load_cert_chain(certfile="server.crt", keyfile="server.key")
     StartTlsServer(
         context,
         identity=identity,
-        certfile="server.crt",
-        keyfile="server.key",
+        sslctx=sslctx,
         address=("127.0.0.1", 8020),
     )
 